@@ -0,0 +1,41 @@
+import os
+import pytest
+import matplotlib
+
+matplotlib.use('Agg')
+
+import synthetic
+import osm_fixture
+from fynesse.config import config
+
+rows = int(os.environ.get('FYNESSE_BENCH_ROWS', 10000))
+start_year = int(os.environ.get('FYNESSE_BENCH_START_YEAR', 2010))
+end_year = int(os.environ.get('FYNESSE_BENCH_END_YEAR', 2022))
+
+
+@pytest.fixture(scope='session')
+def workspace(tmp_path_factory):
+    # A throwaway working directory holding synthetic datasets, a DuckDB database standing in for
+    # MariaDB and a pre-populated OpenStreetMap cache, so no stage touches the network
+    pytest.importorskip('duckdb')
+    pytest.importorskip('pyarrow')
+    from fynesse import access
+
+    directory = tmp_path_factory.mktemp('fynesse')
+    cwd = os.getcwd()
+    saved = dict(config)
+    os.chdir(directory)
+    try:
+        access.create_directories()
+        config.update(backend='duckdb', osm_offline=True, download_revalidate=False)
+        synthetic.write_datasets('datasets', rows, start_year, end_year)
+        osm_fixture.populate(*synthetic.bounds(margin=0.1))
+        access.build_local_database(start_year, end_year)
+        yield {'rows': rows, 'start_year': start_year, 'end_year': end_year}
+    finally:
+        if access.local_conn is not None:
+            access.local_conn.close()
+            access.local_conn = None
+        os.chdir(cwd)
+        config.clear()
+        config.update(saved)
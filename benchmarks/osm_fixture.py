@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from os import makedirs
+from shapely.geometry import LineString, Point
+
+from fynesse import access, cache
+from fynesse.config import config
+from fynesse.utils import osm
+
+road_selectors = [('all', None), ('drive', None)]
+
+highways = ['primary', 'secondary', 'tertiary', 'residential', 'service', 'footway']
+
+grid = 0.005
+
+
+def synthetic_roads(north, south, east, west):
+    # A street grid on absolute grid lines, so ids stay unique across tiles
+    rng = np.random.default_rng(0)
+    rows = np.arange(np.ceil(south / grid), np.floor(north / grid) + 1)
+    columns = np.arange(np.ceil(west / grid), np.floor(east / grid) + 1)
+    lines = [LineString([(west, r * grid), (east, r * grid)]) for r in rows] + \
+        [LineString([(c * grid, south), (c * grid, north)]) for c in columns]
+    index = [('row', int(r)) for r in rows] + [('column', int(c)) for c in columns]
+    return gpd.GeoDataFrame({'highway': rng.choice(highways, len(lines))}, geometry=lines, crs=4326,
+                            index=pd.MultiIndex.from_tuples(index))
+
+
+def synthetic_pois(tags):
+    def fetch(north, south, east, west):
+        rng = np.random.default_rng(1)
+        count = int(200 * (north - south) * (east - west) / grid)
+        pairs = [(key, value) for key, values in tags.items() for value in (['yes'] if values is True else values)]
+        category = rng.integers(0, len(pairs), count)
+        data = {}
+        for k, (key, value) in enumerate(pairs):
+            data.setdefault(key, np.full(count, None, dtype=object))[category == k] = value
+        points = [Point(x, y) for x, y in zip(rng.uniform(west, east, count), rng.uniform(south, north, count))]
+        return gpd.GeoDataFrame(data, geometry=points, crs=4326,
+                                index=pd.MultiIndex.from_tuples([('node', i) for i in range(count)]))
+    return fetch
+
+
+def populate(north, south, east, west):
+    # Fills the OpenStreetMap tile cache for the box from synthetic roads and POIs. It runs at session
+    # setup with the current poi_map and road selectors, so the tiles always match the keys the stages look up
+    makedirs(osm, exist_ok=True)
+    offline = config.get('osm_offline', False)
+    config['osm_offline'] = False
+    try:
+        for network_type, custom_filter in road_selectors:
+            cache.osm_data('roads', [network_type, custom_filter], synthetic_roads, north, south, east, west)
+        cache.osm_data_many('pois', list(config['poi_map'].values()),
+                            lambda selected: synthetic_pois(access.merge_tags(selected)), access.select_pois,
+                            north, south, east, west)
+    finally:
+        config['osm_offline'] = offline
@@ -0,0 +1,85 @@
+import csv
+import numpy as np
+import pandas as pd
+from os import path
+
+# Synthetic sales are spread over postcodes in a box around Cambridge
+centre = (52.2, 0.12)
+spread = 0.15
+
+towns = [('CAMBRIDGE', 'CAMBRIDGE', 'CAMBRIDGESHIRE'),
+         ('CAMBRIDGE', 'SOUTH CAMBRIDGESHIRE', 'CAMBRIDGESHIRE'),
+         ('ELY', 'EAST CAMBRIDGESHIRE', 'CAMBRIDGESHIRE')]
+
+streets = ['HIGH STREET', 'STATION ROAD', 'MILL LANE', 'CHURCH STREET', 'PARK TERRACE']
+
+
+def bounds(margin=0.0):
+    return (centre[0] + spread + margin, centre[0] - spread - margin,
+            centre[1] + spread + margin, centre[1] - spread - margin)
+
+
+def postcodes(count, seed=0):
+    rng = np.random.default_rng(seed)
+    units = np.array([a + b for a in 'ABDEFGHJLNPQRSTUWXYZ' for b in 'ABDEFGHJLNPQRSTUWXYZ'])
+    # Count through units, then sectors, then districts so every generated postcode is distinct
+    index = np.arange(count)
+    unit = units[index % len(units)]
+    sector = (index // len(units)) % 10
+    district = 1 + index // (len(units) * 10)
+    outcode = pd.Series(district).map(lambda d: f"CB{d}")
+    incode = pd.Series(sector).astype(str) + pd.Series(unit)
+    postcode = outcode + ' ' + incode
+    latitude = centre[0] + rng.uniform(-spread, spread, count)
+    longitude = centre[1] + rng.uniform(-spread, spread, count)
+    return pd.DataFrame({
+        'postcode': postcode, 'status': 'live', 'usertype': 'small',
+        'easting': (545000 + (longitude - centre[1]) * 68000).round().astype('int64'),
+        'northing': (258000 + (latitude - centre[0]) * 111000).round().astype('int64'),
+        'positional_quality_indicator': 1, 'country': 'England',
+        'latitude': latitude.round(6), 'longitude': longitude.round(6),
+        'postcode_no_space': postcode.str.replace(' ', ''), 'postcode_fixed_width_seven': postcode.str.pad(7),
+        'postcode_fixed_width_eight': postcode.str.pad(8), 'postcode_area': 'CB', 'postcode_district': outcode,
+        'postcode_sector': outcode + ' ' + pd.Series(sector).astype(str), 'outcode': outcode, 'incode': incode})
+
+
+def price_paid(rows, year, postcode, seed=0):
+    rng = np.random.default_rng([seed, year])
+    town = rng.integers(0, len(towns), rows)
+    day = rng.integers(0, 365, rows)
+    return pd.DataFrame({
+        'transaction_unique_identifier': [f"{{{year:04d}{i:08X}-0000-0000-0000-{seed:012X}}}" for i in range(rows)],
+        'price': np.round(rng.lognormal(12.6 + 0.03 * (year - 1995), 0.5, rows), -2).astype('int64'),
+        'date_of_transfer': (np.datetime64(f"{year}-01-01") + day.astype('timedelta64[D]')).astype(str),
+        'postcode': rng.choice(postcode, rows),
+        'property_type': rng.choice(list('DSTFO'), rows, p=[0.25, 0.25, 0.25, 0.2, 0.05]),
+        'new_build_flag': rng.choice(['N', 'Y'], rows, p=[0.9, 0.1]),
+        'tenure_type': rng.choice(['F', 'L'], rows, p=[0.7, 0.3]),
+        'primary_addressable_object_name': rng.integers(1, 200, rows).astype(str),
+        'secondary_addressable_object_name': '',
+        'street': rng.choice(streets, rows),
+        'locality': '',
+        'town_city': np.array([t[0] for t in towns])[town],
+        'district': np.array([t[1] for t in towns])[town],
+        'county': np.array([t[2] for t in towns])[town],
+        'ppd_category_type': 'A',
+        'record_status': 'A'})
+
+
+def write_datasets(directory, rows, start_year, end_year, postcode_count=None, seed=0, chunk_size=1000000):
+    # Files follow the Land Registry yearly CSVs and the open_postcode_geo layout, so the
+    # loaders read them exactly as they read the real downloads
+    postcode_count = max(rows // 20, 100) if postcode_count is None else postcode_count
+    pc = postcodes(postcode_count, seed)
+    pc.to_csv(path.join(directory, 'open_postcode_geo.csv'), header=False, index=False)
+
+    years = range(start_year, end_year + 1)
+    per_year = np.diff(np.linspace(0, rows, len(years) + 1).round().astype('int64'))
+    for year, count in zip(years, per_year):
+        file_path = path.join(directory, f"{year}.csv")
+        for offset in range(0, max(count, 1), chunk_size):
+            df = price_paid(min(chunk_size, count - offset), year, pc['postcode'].to_numpy(), seed + offset)
+            df['date_of_transfer'] = df['date_of_transfer'] + ' 00:00'
+            df.to_csv(file_path, mode='w' if offset == 0 else 'a', header=False, index=False,
+                      quoting=csv.QUOTE_ALL, lineterminator='\n')
+    return pc
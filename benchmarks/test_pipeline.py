@@ -0,0 +1,60 @@
+import pytest
+
+from fynesse import access, assess, address, cache
+from fynesse.utils import property_types_list
+
+import synthetic
+
+latitude, longitude = synthetic.centre
+date = '2016-06-01'
+
+
+def query(workspace):
+    return dict(start_date=f"{workspace['start_year']}-01-01", end_date=f"{workspace['end_year']}-12-31")
+
+
+def test_ingestion(benchmark, workspace):
+    benchmark.pedantic(access.build_local_database, args=(workspace['start_year'], workspace['end_year']),
+                       rounds=1, iterations=1)
+
+
+@pytest.mark.parametrize('area', ['box', 'town'])
+def test_prices_coordinates_data_cold(benchmark, workspace, area):
+    area = dict(latitude=latitude, longitude=longitude, boxsize='0.1') if area == 'box' else \
+        dict(area_type='town_city', area_name='CAMBRIDGE')
+    benchmark.pedantic(assess.prices_coordinates_data, kwargs={**area, **query(workspace)},
+                       setup=cache.invalidate, rounds=5, iterations=1)
+
+
+@pytest.mark.parametrize('area', ['box', 'town'])
+def test_prices_coordinates_data_warm(benchmark, workspace, area):
+    area = dict(latitude=latitude, longitude=longitude, boxsize='0.1') if area == 'box' else \
+        dict(area_type='town_city', area_name='CAMBRIDGE')
+    assess.prices_coordinates_data(**area, **query(workspace))
+    benchmark(assess.prices_coordinates_data, **area, **query(workspace))
+
+
+def test_labelled(benchmark, workspace):
+    benchmark(assess.labelled, latitude, longitude, date, 'D', 0.05, 0.03, 1800)
+
+
+def test_predict_price_spec(benchmark, workspace):
+    benchmark(address.predict_price_spec, latitude, longitude, date, 'D')
+
+
+@pytest.mark.parametrize('area', ['rollups', 'box'])
+def test_view_queried_graph(benchmark, workspace, area):
+    area = dict(area_type='town_city', area_name='CAMBRIDGE') if area == 'rollups' else \
+        dict(latitude=str(latitude), longitude=str(longitude), boxsize='0.1')
+    year_range = (workspace['start_year'], workspace['end_year'])
+    benchmark.pedantic(assess.view_queried_graph, args=(year_range, property_types_list, 10),
+                       kwargs=dict(**area, show=False), setup=assess.session_cache.clear, rounds=5, iterations=1)
+
+
+@pytest.mark.parametrize('aggregate', [False, True])
+def test_view_map(benchmark, workspace, aggregate):
+    df = assess.prices_coordinates_data(latitude=latitude, longitude=longitude, boxsize='0.1', **query(workspace))
+    benchmark.pedantic(assess.view_map, args=(df, [], 'benchmark'),
+                       kwargs=dict(display_size=10, latitude=latitude, longitude=longitude, boxsize='0.1',
+                                   aggregate=aggregate, show=False),
+                       setup=assess.session_cache.clear, rounds=5, iterations=1)
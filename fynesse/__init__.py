@@ -1,3 +1,15 @@
-from . import access
-from . import address
-from . import assess
+import importlib
+
+# Submodules load on first attribute access (PEP 562), so `import fynesse` stays cheap and
+# pandas, geopandas, osmnx and matplotlib are only imported by the stages that need them
+submodules = ['access', 'address', 'assess', 'cache', 'config', 'download', 'trace', 'utils']
+
+
+def __getattr__(name):
+    if name in submodules:
+        return importlib.import_module(f'.{name}', __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + submodules)
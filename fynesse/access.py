@@ -1,53 +1,225 @@
 from .config import *
 from .utils import *
-
-import yaml
-import csv
+from . import cache
+from . import trace
+from . import download
+from .lazy import lazy
+
+import json
+import math
+import time
+import hashlib
+import queue
 import zipfile
-import pymysql
-import urllib.request
-import osmnx as ox
-from os import path, mkdir, listdir
+import threading
+import numpy as np
+from os import path, mkdir
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+yaml = lazy('yaml')
+pymysql = lazy('pymysql', 'pymysql.cursors')
+pd = lazy('pandas')
+ox = lazy('osmnx')
+gpd = lazy('geopandas')
+duckdb = lazy('duckdb')
+
+
+cached_credentials = None
+local_conn = None
+ledger_filename = 'ledger.json'
+
+# Built after the bulk load by build_indexes, as (table, index name, columns)
+index_definitions = [
+    ('pp_data', 'postcode', '(`postcode`)'),
+    ('pp_data', 'date_of_transfer', '(`date_of_transfer`)'),
+    ('pp_data', 'town_city_date', '(`town_city`(32), `date_of_transfer`)'),
+    ('pp_data', 'district_date', '(`district`(32), `date_of_transfer`)'),
+    ('pp_data', 'county_date', '(`county`(32), `date_of_transfer`)'),
+    ('postcode_data', 'postcode', '(`postcode`)'),
+    ('postcode_data', 'outcode', '(`outcode`)'),
+    ('postcode_data', 'latitude_longitude', '(`latitude`, `longitude`)'),
+    ('transactions', 'postcode', '(`postcode`)'),
+    ('transactions', 'town_city_date', '(`town_city`(32), `date_of_transfer`)'),
+    ('transactions', 'district_date', '(`district`(32), `date_of_transfer`)'),
+    ('transactions', 'county_date', '(`county`(32), `date_of_transfer`)'),
+    ('transactions', 'latitude_longitude', '(`latitude`, `longitude`)')
+]
+
+transactions_columns = ['transaction_unique_identifier', 'price', 'date_of_transfer', 'postcode', 'property_type',
+                        'new_build_flag', 'tenure_type', 'locality', 'town_city', 'district', 'county', 'country',
+                        'latitude', 'longitude']
+transactions_columns_sql = ", ".join(f"`{column}`" for column in transactions_columns)
+transactions_select_sql = ", ".join(f"pc.{column}" if column in ('country', 'latitude', 'longitude') else f"pp.{column}"
+                                    for column in transactions_columns)
+
+# Transactions, deduplicated price paid data joined with postcode coordinates, partitioned by year
+transactions_partitions = ",\n".join(f"PARTITION p{year} VALUES LESS THAN ({year + 1})"
+                                     for year in range(1995, this_year + 1))
+transactions_table = f"""CREATE TABLE IF NOT EXISTS transactions (
+                       `transaction_unique_identifier` varchar(38) COLLATE utf8_bin NOT NULL,
+                       `price` int(10) unsigned NOT NULL,
+                       `date_of_transfer` date NOT NULL,
+                       `postcode` varchar(8) COLLATE utf8_bin NOT NULL,
+                       `property_type` varchar(1) COLLATE utf8_bin NOT NULL,
+                       `new_build_flag` varchar(1) COLLATE utf8_bin NOT NULL,
+                       `tenure_type` varchar(1) COLLATE utf8_bin NOT NULL,
+                       `locality` tinytext COLLATE utf8_bin NOT NULL,
+                       `town_city` tinytext COLLATE utf8_bin NOT NULL,
+                       `district` tinytext COLLATE utf8_bin NOT NULL,
+                       `county` tinytext COLLATE utf8_bin NOT NULL,
+                       `country` enum('England', 'Wales', 'Scotland', 'Northern Ireland', 'Channel Islands', 'Isle of Man') NOT NULL,
+                       `latitude` decimal(11,8) NOT NULL,
+                       `longitude` decimal(10,8) NOT NULL,
+                       PRIMARY KEY (`transaction_unique_identifier`, `date_of_transfer`)
+                     ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin
+                     PARTITION BY RANGE (YEAR(`date_of_transfer`)) (
+                       {transactions_partitions},
+                       PARTITION pmax VALUES LESS THAN MAXVALUE
+                     );"""
+
+# Rollups hold a log-bucketed histogram of prices, so sketches merge by adding counts. Quantiles read from
+# them interpolate between ranks as np.quantile does, and are within rollup_accuracy relative error of it
+price_rollups_table = """CREATE TABLE IF NOT EXISTS price_rollups (
+                           area_type varchar(9) NOT NULL,
+                           area_name varchar(64) NOT NULL,
+                           transfer_year smallint NOT NULL,
+                           property_type varchar(1) NOT NULL,
+                           bucket smallint NOT NULL,
+                           sales integer NOT NULL,
+                           PRIMARY KEY (area_type, area_name, transfer_year, property_type, bucket)
+                         )"""
+
+outcode_expressions = {
+    'mariadb': "SUBSTRING_INDEX(postcode, ' ', 1)",
+    'duckdb': "split_part(postcode, ' ', 1)"
+}
+
+postcode_data_columns = ['postcode', 'status', 'usertype', 'easting', 'northing', 'positional_quality_indicator',
+                         'country', 'latitude', 'longitude', 'postcode_no_space', 'postcode_fixed_width_seven',
+                         'postcode_fixed_width_eight', 'postcode_area', 'postcode_district', 'postcode_sector',
+                         'outcode', 'incode']
+
+pp_data_columns = ['transaction_unique_identifier', 'price', 'date_of_transfer', 'postcode', 'property_type',
+                   'new_build_flag', 'tenure_type', 'primary_addressable_object_name',
+                   'secondary_addressable_object_name', 'street', 'locality', 'town_city', 'district', 'county',
+                   'ppd_category_type', 'record_status']
+
+pool = queue.LifoQueue()
+pool_slots = None
+pool_lock = threading.Lock()
 
 
 def write_credentials(username, password):
+    global cached_credentials
     with open("credentials.yaml", "w") as file:
         credentials_dict = {'username': username,
                             'password': password}
         yaml.dump(credentials_dict, file)
+    cached_credentials = None
 
 
 def get_credentials():
-    with open("credentials.yaml") as file:
-        credentials = yaml.safe_load(file)
-    return credentials["username"], credentials["password"]
+    global cached_credentials
+    if cached_credentials is None:
+        with open("credentials.yaml") as file:
+            credentials = yaml.safe_load(file)
+        cached_credentials = credentials["username"], credentials["password"]
+    return cached_credentials
 
 
 def create_directories():
-    directories = ('tables', 'datasets', 'maps', 'graphs')
+    directories = ('tables', 'datasets', 'maps', 'graphs', 'osm', 'models')
 
     for directory in directories:
         if not path.exists(directory):
             mkdir(directory)
-    print("Created directories\n")
+    trace.progress("Created directories\n")
 
 
 def create_connection():
-    conn = None
     credentials = get_credentials()
+    retries = config.get('connection_retries', 3)
+    for attempt in range(retries + 1):
+        try:
+            conn = pymysql.connect(user=credentials[0],
+                                   password=credentials[1],
+                                   host=config['database_url'],
+                                   port=config['port'],
+                                   local_infile=1)
+            break
+        except pymysql.err.OperationalError as e:
+            if attempt == retries:
+                raise ConnectionError(f"Error connecting to the MariaDB Server: {e}") from e
+            time.sleep(config.get('connection_backoff', 0.5) * 2 ** attempt)
+    conn.database_selected = False
+    select_database(conn)
+    return conn
+
+
+def select_database(conn):
+    if not conn.database_selected:
+        try:
+            conn.select_db('property_prices')
+            conn.database_selected = True
+        except pymysql.err.OperationalError:
+            # The database does not exist until initialize_database has been run
+            pass
+    return conn
+
+
+def healthy_connection(conn):
+    if conn is not None:
+        try:
+            conn.ping()
+            return select_database(conn)
+        except pymysql.err.Error:
+            close_connection(conn)
+    return create_connection()
+
+
+def close_connection(conn):
     try:
-        conn = pymysql.connect(user=credentials[0],
-                               password=credentials[1],
-                               host=config['database_url'],
-                               port=config['port'],
-                               local_infile=1)
-        return conn
-    except Exception as e:
-        print(f"Error connecting to the MariaDB Server: {e}")
+        conn.close()
+    except pymysql.err.Error:
+        pass
+
+
+@contextmanager
+def connection():
+    global pool_slots
+    with pool_lock:
+        if pool_slots is None:
+            pool_slots = threading.BoundedSemaphore(config.get('pool_size', 4))
+    pool_slots.acquire()
+    try:
+        try:
+            conn = pool.get_nowait()
+        except queue.Empty:
+            conn = None
+        conn = healthy_connection(conn)
+        try:
+            yield conn
+        except BaseException:
+            # The connection may be left mid-transaction or mid-result, so it is not returned to the pool
+            close_connection(conn)
+            raise
+        else:
+            pool.put(conn)
+    finally:
+        pool_slots.release()
+
+
+def close_pool():
+    while True:
+        try:
+            close_connection(pool.get_nowait())
+        except queue.Empty:
+            break
 
 
 def initialize_database():
-    with create_connection() as conn:
+    with connection() as conn:
         with conn.cursor() as cur:
             cur.execute(f"""SET SQL_MODE = "NO_AUTO_VALUE_ON_ZERO";""")
             cur.execute(f"""SET time_zone = "+00:00";""")
@@ -55,14 +227,18 @@ def initialize_database():
             CHARACTER SET utf8 COLLATE utf8_bin;""")
             cur.execute(f"""USE property_prices""")
             conn.commit()
+            conn.database_selected = True
 
-            print("Initialised database\n")
+            trace.progress("Initialised database\n")
+
+            cache.invalidate()
+            reset_ledger()
 
             # Price Paid Data
             cur.execute(f"""DROP TABLE IF EXISTS pp_data""")
             conn.commit()
             cur.execute(f"""CREATE TABLE IF NOT EXISTS pp_data (
-                              `transaction_unique_identifier` tinytext COLLATE utf8_bin NOT NULL,
+                              `transaction_unique_identifier` varchar(38) COLLATE utf8_bin NOT NULL,
                               `price` int(10) unsigned NOT NULL,
                               `date_of_transfer` date NOT NULL,
                               `postcode` varchar(8) COLLATE utf8_bin NOT NULL,
@@ -78,11 +254,12 @@ def initialize_database():
                               `county` tinytext COLLATE utf8_bin NOT NULL,
                               `ppd_category_type` varchar(2) COLLATE utf8_bin NOT NULL,
                               `record_status` varchar(2) COLLATE utf8_bin NOT NULL,
-                              `db_id` bigint(20) unsigned NOT NULL AUTO_INCREMENT PRIMARY KEY
+                              `db_id` bigint(20) unsigned NOT NULL AUTO_INCREMENT PRIMARY KEY,
+                              UNIQUE KEY `transaction_unique_identifier` (`transaction_unique_identifier`)
                             )DEFAULT CHARSET=utf8 COLLATE=utf8_bin AUTO_INCREMENT=1;""")
             conn.commit()
 
-            print("Initialised price paid data table\n")
+            trace.progress("Initialised price paid data table\n")
 
             # Postcode Data
             cur.execute(f"""DROP TABLE IF EXISTS postcode_data""")
@@ -109,164 +286,633 @@ def initialize_database():
                             ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin;""")
             conn.commit()
 
-            print("Initialised postcode data table\n")
+            trace.progress("Initialised postcode data table\n")
 
+            # Transactions, deduplicated price paid data joined with postcode coordinates
+            cur.execute(f"""DROP TABLE IF EXISTS transactions""")
+            conn.commit()
+            cur.execute(transactions_table)
+            conn.commit()
 
-def upload_price_paid_data(year=1995):
-    while True:
-        filename = str(year) + ".csv"
-        file_path = path.join(datasets, filename)
-        url = config['price_paid_data_url_prefix'] + filename
-        if not path.exists(file_path):
+            trace.progress("Initialised transactions table\n")
+
+            # Price rollups, mergeable price sketches by area, year and property type
+            cur.execute(f"""DROP TABLE IF EXISTS price_rollups""")
+            cur.execute(price_rollups_table)
+            conn.commit()
+
+            trace.progress("Initialised price rollups table\n")
+
+
+def read_ledger():
+    ledger_path = path.join(datasets, ledger_filename)
+    if not path.exists(ledger_path):
+        return {}
+    with open(ledger_path) as file:
+        return json.load(file)
+
+
+def write_ledger(ledger):
+    ledger_path = path.join(datasets, ledger_filename)
+    with open(ledger_path + '.tmp', 'w') as file:
+        json.dump(ledger, file, indent=2, sort_keys=True)
+    os.replace(ledger_path + '.tmp', ledger_path)
+
+
+def reset_ledger():
+    if path.exists(path.join(datasets, ledger_filename)):
+        os.remove(path.join(datasets, ledger_filename))
+
+
+def file_checksum(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@trace.traced()
+def download_price_paid_year(year):
+    filename = str(year) + ".csv"
+    file_path = path.join(datasets, filename)
+    url = config['price_paid_data_url_prefix'] + filename
+    if download.fetch(url, file_path):
+        trace.current().miss()
+        trace.progress(filename + " is downloaded.\n")
+    else:
+        trace.current().hit()
+        trace.progress(filename + " has already been downloaded.\n")
+    trace.current().add(bytes=path.getsize(file_path))
+    return file_path
+
+
+@trace.traced()
+def load_price_paid_year(year, file_path, ledger, ledger_lock):
+    size = path.getsize(file_path)
+    checksum = file_checksum(file_path)
+    entry = ledger.get(str(year))
+    if entry is not None and entry['size'] == size and entry['checksum'] == checksum:
+        trace.progress(f"{year}.csv has already been loaded ({entry['rows']} rows).\n")
+        return False
+
+    start = time.time()
+    with connection() as conn:
+        with conn.cursor() as cur:
+            if entry is not None:
+                # The file changed since it was loaded, so replace that year rather than duplicating it
+                cur.execute(f"""DELETE FROM pp_data WHERE date_of_transfer >= '{year}-01-01' AND
+                                date_of_transfer <= '{year}-12-31'""")
+            rows = cur.execute(f"""LOAD DATA LOCAL INFILE '{file_path}'
+                                   REPLACE INTO TABLE pp_data FIELDS TERMINATED BY ',' ENCLOSED BY '"'
+                                   LINES STARTING BY '' TERMINATED BY '\n'""")
+            conn.commit()
+    seconds = time.time() - start
+    trace.current().add(rows=rows, bytes=size)
+
+    with ledger_lock:
+        ledger[str(year)] = {'size': size, 'checksum': checksum, 'rows': rows, 'seconds': round(seconds, 3)}
+        write_ledger(ledger)
+    trace.progress(f"{year}.csv loaded: {rows} rows in {seconds:.1f}s "
+                   f"({rows / max(seconds, 1e-9):.0f} rows/s, {size / max(seconds, 1e-9) / 2 ** 20:.1f} MiB/s)\n")
+    return True
+
+
+@trace.traced()
+def upload_price_paid_data(year=1995, end_year=this_year):
+    ledger = read_ledger()
+    ledger_lock = threading.Lock()
+    failed = []
+    loaded = []
+
+    # Downloads run in parallel, but years load one at a time while later years download: concurrent
+    # LOAD DATA ... REPLACE into pp_data would serialise on its AUTO_INCREMENT lock and risk deadlocks
+    # on the unique key
+    with ThreadPoolExecutor(config.get('download_workers', 4)) as downloads, ThreadPoolExecutor(1) as loads:
+        pending = {downloads.submit(trace.bind(download_price_paid_year), y): y for y in range(year, end_year + 1)}
+        loading = {}
+        for future in as_completed(pending):
+            y = pending[future]
             try:
-                urllib.request.urlretrieve(url, file_path)
-            except Exception as _:
-                break
-            print(filename + " is downloaded.\n")
-        else:
-            print(filename + " has already been downloaded.\n")
+                file_path = future.result()
+            except Exception as e:
+                if isinstance(e, FileNotFoundError) and y == this_year:
+                    # The current year is not published until its first monthly release, which is not a failure
+                    trace.progress(f"{y}.csv is not available yet.\n")
+                    continue
+                trace.progress(f"{y}.csv could not be downloaded: {e}\n")
+                failed.append(y)
+                continue
+            loading[loads.submit(trace.bind(load_price_paid_year), y, file_path, ledger, ledger_lock)] = y
+
+        for future in as_completed(loading):
+            try:
+                if future.result():
+                    loaded.append(loading[future])
+            except Exception as e:
+                trace.progress(f"{loading[future]}.csv could not be loaded: {e}\n")
+                failed.append(loading[future])
+
+    if loaded:
+        refresh_transactions(loaded)
+        cache.invalidate()
+    if failed:
+        trace.progress(f"Failed years (rerun to resume): {sorted(failed)}\n")
+    else:
+        trace.progress("Uploaded all available price paid data\n")
 
-        with create_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute(f"""USE property_prices""")
-                cur.execute(f"""LOAD DATA LOCAL INFILE '{file_path}'
-                                INTO TABLE pp_data FIELDS TERMINATED BY ',' ENCLOSED BY '"'
-                                LINES STARTING BY '' TERMINATED BY '\n'""")
-                conn.commit()
 
-        year += 1
-    print("Uploaded all available price paid data\n")
+@trace.traced()
+def update_price_paid_data(url=None):
+    url = config['price_paid_monthly_update_url'] if url is None else url
+    file_path = path.join(datasets, 'monthly-update.csv')
+    if download.fetch(url, file_path):
+        trace.progress("monthly-update.csv is downloaded.\n")
 
+    ledger = read_ledger()
+    checksum = file_checksum(file_path)
+    if ledger.get('monthly-update', {}).get('checksum') == checksum:
+        trace.progress("monthly-update.csv has already been applied.\n")
+        return
 
-def upload_postcode_data():
+    with connection() as conn:
+        with conn.cursor() as cur:
+            migrate = not table_exists(cur, 'transactions')
+    if migrate:
+        refresh_transactions()
+
+    columns = ", ".join(f"`{column}`" for column in pp_data_columns)
+    with connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"""CREATE TABLE IF NOT EXISTS pp_staging LIKE pp_data""")
+            cur.execute(f"""TRUNCATE TABLE pp_staging""")
+            cur.execute(f"""LOAD DATA LOCAL INFILE '{file_path}'
+                            REPLACE INTO TABLE pp_staging FIELDS TERMINATED BY ',' ENCLOSED BY '"'
+                            LINES STARTING BY '' TERMINATED BY '\n'""")
+            cur.execute(f"""SELECT record_status, COUNT(*) FROM pp_staging GROUP BY record_status""")
+            counts = dict(cur.fetchall())
+            cur.execute(f"""SELECT DISTINCT YEAR(date_of_transfer) FROM pp_staging""")
+            years = [year for year, in cur.fetchall()]
+            cur.execute(f"""DELETE pp FROM pp_data pp INNER JOIN pp_staging st
+                            ON pp.transaction_unique_identifier = st.transaction_unique_identifier
+                            WHERE st.record_status = 'D'""")
+            cur.execute(f"""REPLACE INTO pp_data ({columns})
+                            SELECT {columns} FROM pp_staging WHERE record_status IN ('A', 'C')""")
+            cur.execute(f"""DELETE tr FROM transactions tr INNER JOIN pp_staging st
+                            ON tr.transaction_unique_identifier = st.transaction_unique_identifier""")
+            cur.execute(f"""INSERT INTO transactions ({transactions_columns_sql})
+                            SELECT {transactions_select_sql}
+                            FROM pp_staging pp INNER JOIN postcode_data pc ON pp.postcode = pc.postcode
+                            WHERE pp.record_status IN ('A', 'C')""")
+            conn.commit()
+
+    delta = None
+    if set(counts) == {'A'}:
+        # Pure additions are kept as a delta so stored models can fold them in instead of refitting
+        with cache.TableWriter(get_delta_filename(checksum[:16])) as writer:
+            for chunk in query_prices_coordinates("""transaction_unique_identifier IN
+                                                     (SELECT transaction_unique_identifier FROM pp_staging)""",
+                                                  '1995-01-01', str(this_year) + '-12-31', backend='mariadb'):
+                writer.write(chunk)
+        delta = writer.path
+    execute_statements([f"""TRUNCATE TABLE pp_staging"""], backend='mariadb')
+
+    ledger['monthly-update'] = {'checksum': checksum, 'rows': sum(counts.values())}
+    write_ledger(ledger)
+    refresh_rollups(years, backend='mariadb')
+    cache.invalidate(delta)
+    trace.progress(f"Applied monthly update: {counts.get('A', 0)} added, {counts.get('C', 0)} changed, "
+                   f"{counts.get('D', 0)} deleted\n")
+
+
+@trace.traced()
+def download_postcode_data():
     postcode_file_path = path.join(datasets, 'open_postcode_geo.csv')
-    postcode_zip_path = 'open_postcode_geo.csv.zip'
+    postcode_zip_path = path.join(datasets, 'open_postcode_geo.csv.zip')
 
-    if not path.exists(postcode_file_path):
-        opener = urllib.request.build_opener()
-        opener.addheaders = [('User-agent', 'Mozilla/5.0')]
-        urllib.request.install_opener(opener)
-        urllib.request.urlretrieve(config['postcode_data_url'], postcode_zip_path)
+    # The zip is kept next to the extracted file so later runs can revalidate it instead of downloading it again
+    if not path.exists(postcode_file_path) or path.exists(postcode_zip_path):
+        if download.fetch(config['postcode_data_url'], postcode_zip_path) or not path.exists(postcode_file_path):
+            with zipfile.ZipFile(postcode_zip_path, 'r') as zip_ref:
+                zip_ref.extract('open_postcode_geo.csv', datasets)
+    return postcode_file_path
 
-    with zipfile.ZipFile(postcode_zip_path, 'r') as zip_ref:
-        zip_ref.extract('open_postcode_geo.csv', datasets)
-    os.remove(postcode_zip_path)
 
-    with create_connection() as conn:
+@trace.traced()
+def upload_postcode_data():
+    postcode_file_path = download_postcode_data()
+
+    with connection() as conn:
         with conn.cursor() as cur:
-            cur.execute(f"""USE property_prices""")
             cur.execute(f"""LOAD DATA LOCAL INFILE '{postcode_file_path}' INTO TABLE postcode_data
                             FIELDS TERMINATED BY ',' 
                             LINES STARTING BY '' TERMINATED BY '\n';""")
             conn.commit()
-    print("Uploaded postcode data\n")
+    refresh_transactions()
+    cache.invalidate()
+    trace.progress("Uploaded postcode data\n")
+
+
+def local_database():
+    global local_conn
+    if local_conn is None:
+        local_conn = duckdb.connect(config.get('local_database', path.join(datasets, 'property_prices.duckdb')))
+    return local_conn
+
+
+@trace.traced()
+def build_local_database(year=1995, end_year=this_year):
+    global local_conn
+    with ThreadPoolExecutor(config.get('download_workers', 4)) as downloads:
+        futures = {downloads.submit(trace.bind(download_price_paid_year), y): y for y in range(year, end_year + 1)}
+        price_paid_files = []
+        for future, y in futures.items():
+            try:
+                price_paid_files.append(future.result())
+            except Exception as e:
+                if isinstance(e, FileNotFoundError) and y == this_year:
+                    trace.progress(f"{y}.csv is not available yet.\n")
+                    continue
+                trace.progress(f"A price paid file could not be downloaded: {e}\n")
+    postcode_file_path = download_postcode_data()
+
+    if local_conn is not None:
+        local_conn.close()
+        local_conn = None
+    database_path = config.get('local_database', path.join(datasets, 'property_prices.duckdb'))
+    if path.exists(database_path):
+        os.remove(database_path)
+
+    start = time.time()
+    pp_columns = ", ".join(f"'{column}': 'VARCHAR'" for column in pp_data_columns)
+    pc_columns = ", ".join(f"'{column}': 'VARCHAR'" for column in postcode_data_columns)
+    conn = local_database()
+    conn.execute(f"""CREATE TABLE transactions AS
+                     SELECT pp.transaction_unique_identifier, CAST(pp.price AS INTEGER) AS price,
+                     CAST(pp.date_of_transfer[1:10] AS DATE) AS date_of_transfer, pp.postcode, pp.property_type,
+                     pp.new_build_flag, pp.tenure_type, pp.locality, pp.town_city, pp.district, pp.county,
+                     pc.country, CAST(pc.latitude AS DOUBLE) AS latitude, CAST(pc.longitude AS DOUBLE) AS longitude
+                     FROM read_csv({price_paid_files}, header = false, quote = '"', allow_quoted_nulls = false,
+                                   columns = {{{pp_columns}}}) pp
+                     INNER JOIN
+                     read_csv('{postcode_file_path}', header = false, columns = {{{pc_columns}}}) pc
+                     ON pp.postcode = pc.postcode
+                     WHERE TRY_CAST(pc.latitude AS DOUBLE) IS NOT NULL
+                     QUALIFY row_number() OVER (PARTITION BY pp.transaction_unique_identifier) = 1
+                     ORDER BY date_of_transfer""")
+    rows = conn.execute(f"""SELECT COUNT(*) FROM transactions""").fetchone()[0]
+    conn.execute(price_rollups_table)
+    refresh_rollups(backend='duckdb')
+    cache.invalidate()
+    trace.progress(f"Built local database with {rows} transactions in {time.time() - start:.1f}s\n")
+
+
+def table_exists(cur, table):
+    cur.execute(f"""SHOW TABLES LIKE '{table}'""")
+    return bool(cur.fetchall())
+
+
+@trace.traced()
+def refresh_transactions(years=None):
+    # Databases initialised before the transactions table existed are migrated here: the table is created
+    # and filled for every year, whichever years were asked for, and the price rollups are rebuilt after it
+    years = range(1995, this_year + 1) if years is None else sorted(years)
+    with connection() as conn:
+        with conn.cursor() as cur:
+            if not table_exists(cur, 'transactions'):
+                cur.execute(transactions_table)
+                years = range(1995, this_year + 1)
+            for year in years:
+                start = time.time()
+                cur.execute(f"""DELETE FROM transactions WHERE date_of_transfer >= '{year}-01-01' AND
+                                date_of_transfer <= '{year}-12-31'""")
+                rows = cur.execute(f"""INSERT INTO transactions ({transactions_columns_sql})
+                                       SELECT {transactions_select_sql}
+                                       FROM pp_data pp INNER JOIN postcode_data pc ON pp.postcode = pc.postcode
+                                       WHERE pp.date_of_transfer >= '{year}-01-01' AND
+                                       pp.date_of_transfer <= '{year}-12-31'""")
+                conn.commit()
+                trace.progress(f"Refreshed {rows} transactions for {year} in {time.time() - start:.1f}s\n")
+    refresh_rollups(years, backend='mariadb')
+
+
+def execute_statements(queries, backend=None):
+    # backend defaults to the configured query backend; ingest stages that only exist for MariaDB pass it
+    backend = config.get('backend', 'mariadb') if backend is None else backend
+    if backend == 'duckdb':
+        cur = local_database().cursor()
+        for query in queries:
+            cur.execute(query)
+        return
+    with connection() as conn:
+        with conn.cursor() as cur:
+            for query in queries:
+                cur.execute(query)
+        conn.commit()
 
 
+@trace.traced()
+def refresh_rollups(years=None, backend=None):
+    years = range(1995, this_year + 1) if years is None else sorted(years)
+    backend = config.get('backend', 'mariadb') if backend is None else backend
+    if backend == 'mariadb':
+        with connection() as conn:
+            with conn.cursor() as cur:
+                if not table_exists(cur, 'price_rollups'):
+                    # Rollups covering only the refreshed years would silently replace full graphs, so a
+                    # database initialised before rollups existed gets every year built
+                    cur.execute(price_rollups_table)
+                    conn.commit()
+                    years = range(1995, this_year + 1)
+    log_gamma = math.log(rollup_gamma())
+    area_expressions = {'town_city': 'town_city', 'district': 'district', 'county': 'county',
+                        'outcode': outcode_expressions[backend]}
+    start = time.time()
+    for year in years:
+        queries = [f"""DELETE FROM price_rollups WHERE transfer_year = {year}"""]
+        for area_type, expression in area_expressions.items():
+            queries.append(f"""INSERT INTO price_rollups
+                               SELECT '{area_type}', {expression}, {year}, property_type,
+                               CEIL(LN(GREATEST(price, 1)) / {log_gamma}) AS bucket, COUNT(*)
+                               FROM transactions
+                               WHERE date_of_transfer >= '{year}-01-01' AND date_of_transfer <= '{year}-12-31'
+                               GROUP BY {expression}, property_type, bucket""")
+        execute_statements(queries, backend)
+    trace.progress(f"Refreshed price rollups for {len(years)} years in {time.time() - start:.1f}s\n")
+
+
+def rollup_gamma():
+    accuracy = config.get('rollup_accuracy', 0.01)
+    return (1 + accuracy) / (1 - accuracy)
+
+
+@trace.traced()
+def price_rollups_data(area_type='town_city', area_name='CAMBRIDGE', outcode=None, start_year=2013, end_year=this_year):
+    if outcode is not None:
+        area_type, area_name = 'outcode', outcode
+    query = f"""SELECT transfer_year, property_type, bucket, sales FROM price_rollups
+                WHERE area_type = '{area_type}' AND area_name = '{area_name}' AND
+                transfer_year >= {start_year} AND transfer_year <= {end_year}"""
+    columns = ['year', 'property type', 'bucket', 'sales']
+    try:
+        chunks = list(query_chunks(query, columns))
+    except Exception as e:
+        if not missing_table(e):
+            raise
+        # Empty rollups make view_queried_graph compute the graph from transactions instead
+        trace.progress("The price_rollups table is missing. Run access.refresh_rollups() once to build it.\n")
+        chunks = []
+    return pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=columns)
+
+
+@trace.traced()
+def build_indexes():
+    report = []
+    with connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"""SELECT table_name, index_name FROM information_schema.statistics
+                            WHERE table_schema = 'property_prices'""")
+            existing = set(cur.fetchall())
+
+            for table, name, columns in index_definitions:
+                if (table, name) in existing:
+                    continue
+                start = time.time()
+                cur.execute(f"""ALTER TABLE {table} ADD INDEX `{name}` {columns}""")
+                conn.commit()
+                report.append((table, name, time.time() - start))
+                trace.progress(f"Built index {name} on {table} in {report[-1][2]:.1f}s\n")
+
+            cur.execute(f"""ANALYZE TABLE pp_data, postcode_data, transactions""")
+            cur.fetchall()
+            cur.execute(f"""SELECT table_name, index_name, stat_value * @@innodb_page_size
+                            FROM mysql.innodb_index_stats
+                            WHERE database_name = 'property_prices' AND stat_name = 'size'""")
+            sizes = {(table, index): size for table, index, size in cur.fetchall()}
+
+    report = pd.DataFrame(report, columns=['table', 'index', 'build seconds'])
+    report['bytes'] = [sizes.get((table, index)) for table, index in zip(report['table'], report['index'])]
+    trace.progress(report.to_string(index=False) + "\n")
+    return report
+
+
+def query_chunks(query, columns, chunk_size=None, backend=None):
+    chunk_size = config.get('stream_chunk_size', 100000) if chunk_size is None else chunk_size
+    backend = config.get('backend', 'mariadb') if backend is None else backend
+    if backend == 'duckdb':
+        reader = local_database().cursor().execute(query).fetch_record_batch(chunk_size)
+        for batch in reader:
+            if batch.num_rows:
+                trace.current().add(rows=batch.num_rows, bytes=batch.nbytes)
+                yield batch.to_pandas().set_axis(columns, axis=1)
+        return
+
+    cursor_class = pymysql.cursors.SSCursor if config.get('streaming', True) else pymysql.cursors.Cursor
+    with connection() as conn:
+        with conn.cursor(cursor_class) as cur:
+            cur.execute(query)
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                trace.current().add(rows=len(rows))
+                yield pd.DataFrame(rows, columns=columns)
+
+
+def missing_table(e):
+    # MariaDB error 1146, raised for databases initialised before a table was introduced
+    return isinstance(e, pymysql.err.ProgrammingError) and e.args[0] == 1146
+
+
+def query_prices_coordinates(condition, start_date, end_date, chunk_size=None, source='transactions', backend=None):
+    query = f"""SELECT price, date_of_transfer, postcode, property_type, new_build_flag, tenure_type, locality,
+                town_city, district, county, country, latitude, longitude
+                FROM {source} WHERE ({condition}) AND
+                date_of_transfer >= '{start_date}' AND
+                date_of_transfer <= '{end_date}'"""
+    chunks = query_chunks(query, table_column_list, chunk_size, backend)
+    try:
+        first = next(chunks, None)
+    except Exception as e:
+        if source != 'transactions' or not missing_table(e):
+            raise
+        trace.progress("The transactions table is missing, so pp_data is joined with postcode_data instead. "
+                       "Run access.refresh_transactions() once to build it.\n")
+        # The derived table keeps the unqualified column names that conditions are written against
+        yield from query_prices_coordinates(condition, start_date, end_date, chunk_size,
+                                            f"""(SELECT {transactions_select_sql} FROM pp_data pp
+                                                INNER JOIN postcode_data pc ON pp.postcode = pc.postcode)
+                                                AS transactions""", backend)
+        return
+    if first is not None:
+        yield cache.typed_frame(first)
+    for chunk in chunks:
+        yield cache.typed_frame(chunk)
+
+
+@trace.traced()
+def tiled_prices_coordinates_data(lat_min, lat_max, lon_min, lon_max, start_date, end_date):
+    paths = []
+    missing = []
+    for key, box, tile_start, tile_end in cache.tiles(lat_min, lat_max, lon_min, lon_max, start_date, end_date):
+        cached = cache.lookup('tile', key, tile_start, tile_end)
+        if cached is None:
+            missing.append((key, box, tile_start, tile_end))
+        else:
+            paths.append(cached)
+    trace.current().hit(len(paths))
+    trace.current().miss(len(missing))
+
+    if missing:
+        trace.progress(f"Fetching {len(missing)} uncached tiles...\n")
+        condition = " OR ".join(f"""(latitude >= {box[0]} AND latitude < {box[1]} AND
+                                      longitude >= {box[2]} AND longitude < {box[3]} AND
+                                      date_of_transfer >= '{tile_start}' AND date_of_transfer <= '{tile_end}')"""
+                                 for _, box, tile_start, tile_end in missing)
+
+        writers = {key: cache.TableWriter(get_tile_filename(key)) for key, _, _, _ in missing}
+        try:
+            for chunk in query_prices_coordinates(condition, min(tile_start for _, _, tile_start, _ in missing),
+                                                  max(tile_end for _, _, _, tile_end in missing)):
+                for key, tile in chunk.groupby(cache.tile_keys(chunk)):
+                    writers[key].write(tile)
+        except BaseException:
+            for writer in writers.values():
+                writer.discard()
+            raise
+        for writer in writers.values():
+            writer.close()
+
+        protect = paths + [writer.path for writer in writers.values()]
+        for key, box, tile_start, tile_end in missing:
+            cache.record(writers[key].path, 'tile', key, tile_start, tile_end, writers[key].rows, box=box,
+                         protect=protect)
+        paths = protect
+    return paths
+
+
+@trace.traced()
 def prices_coordinates_data(area_type='town_city', area_name='CAMBRIDGE', outcode=None, latitude=None,
                             longitude=None, boxsize='0.1',
                             start_date='2013-01-01', end_date=str(this_year) + '-12-31'):
-    print('Retrieving property data... this may take a while if not cached locally...\n')
-
+    trace.progress('Retrieving property data... this may take a while if not cached locally...\n')
 
     if latitude is not None and longitude is not None:
         two = Decimal(2)
         latitude = Decimal(latitude)
         longitude = Decimal(longitude)
         boxsize = Decimal(boxsize)
-        lat_min = latitude - boxsize / two
-        lat_max = latitude + boxsize / two
-        lon_min = longitude - boxsize / two
-        lon_max = longitude + boxsize / two
-        pp_condition = ""
-        pc_condition = f"""
-        WHERE latitude >= {lat_min} AND
-        latitude < {lat_max} AND
-        longitude >= {lon_min} AND
-        longitude < {lon_max}
-        """
-        filename = get_filename(latitude=latitude, longitude=longitude, boxsize=boxsize,
-                                start_date=start_date, end_date=end_date)
-
-        def tp(x):
-            if not (x[0] == 'coordinate_box_size'):
-                return False
-            lat = Decimal(x[1])
-            lon = Decimal(x[2])
-            bs = Decimal(x[3])
-            lat_min_x = lat - bs / two
-            lat_max_x = lat + bs / two
-            lon_min_x = lon - bs / two
-            lon_max_x = lon + bs / two
-            return (lat_min_x < lat_min or isclose(lat_min_x, lat_min)) and \
-                   (lon_min_x < lon_min or isclose(lon_min_x, lon_min)) and \
-                   (lat_max_x > lat_max or isclose(lat_max_x, lat_max)) and \
-                   (lon_max_x > lon_max or isclose(lon_max_x, lon_max))
-
-        type_predicate = tp
+        return tiled_prices_coordinates_data(latitude - boxsize / two, latitude + boxsize / two,
+                                             longitude - boxsize / two, longitude + boxsize / two,
+                                             start_date, end_date)
     elif outcode is not None:
-        pp_condition = ""
-        pc_condition = f"WHERE outcode = '{outcode}'"
+        condition = f"postcode LIKE '{outcode} %'"
         filename = get_filename(outcode=outcode, start_date=start_date, end_date=end_date)
-        type_predicate = (lambda x: x[0] == 'outcode' and x[1] == outcode)
+        area = ('outcode', outcode)
     else:
-        pp_condition = f"{area_type} = '{area_name}' AND"
-        pc_condition = ""
+        condition = f"{area_type} = '{area_name}'"
         filename = get_filename(area_type=area_type, area_name=area_name, start_date=start_date, end_date=end_date)
-        type_predicate = (lambda x: x[0] == area_type and x[1] == area_name)
+        area = (area_type, area_name)
+
+    cached = cache.lookup(area[0], area[1], start_date, end_date)
+    if cached is not None:
+        trace.current().hit()
+        return cached
+    trace.current().miss()
+
+    with cache.TableWriter(filename) as writer:
+        for chunk in query_prices_coordinates(condition, start_date, end_date):
+            writer.write(chunk)
+    cache.record(writer.path, area[0], area[1], start_date, end_date, writer.rows)
+    return writer.path
+
+
+def fetch_road_data(network_type, custom_filter):
+    def fetch(north, south, east, west):
+        try:
+            _, edges = ox.graph_to_gdfs(ox.graph_from_bbox(north, south, east, west,
+                                                           network_type=network_type,
+                                                           truncate_by_edge=True,
+                                                           custom_filter=custom_filter))
+        except ValueError:
+            # Raised by osmnx when the box holds no matching roads
+            return gpd.GeoDataFrame({'highway': []}, geometry=gpd.GeoSeries([], crs=4326))
+        edges['highway'] = edges['highway'].map(lambda x: x[0] if isinstance(x, list) else x)
+        return edges[['highway', 'geometry']]
+    return fetch
+
+
+def fetch_pois_data(tags):
+    def fetch(north, south, east, west):
+        try:
+            pois = ox.geometries_from_bbox(north, south, east, west, tags)
+        except ValueError:
+            return gpd.GeoDataFrame(geometry=gpd.GeoSeries([], crs=4326))
+        return pois[[key for key in tags if key in pois] + ['geometry']]
+    return fetch
+
+
+@trace.traced('osm roads')
+def road_data(north, south, east, west, network_type, custom_filter):
+    return cache.osm_data('roads', [network_type, custom_filter], fetch_road_data(network_type, custom_filter),
+                          north, south, east, west)
 
-    filename = filename + '.csv'
-    date_predicate = (lambda x: comp_date(x[-3], start_date) and comp_date(end_date, x[-2]))
 
-    for fn in listdir(tables):
-        parts = fn.split('#')
-        if type_predicate(parts) and date_predicate(parts):
-            return path.join(tables, fn), True
+def merge_tags(tags):
+    merged = {}
+    for tag in tags:
+        for key, values in tag.items():
+            if values is True or merged.get(key) is True:
+                merged[key] = True
+            else:
+                merged[key] = sorted(set(merged.get(key, [])) | set(values if isinstance(values, list) else [values]))
+    return merged
 
-    with create_connection() as conn:
-        with conn.cursor() as cur:
-            cur.execute(f"""USE property_prices""")
-            cur.execute(f"""SELECT pp.price, pp.date_of_transfer, pp.postcode, pp.property_type,
-                            pp.new_build_flag, pp.tenure_type, pp.locality, pp.town_city, pp.district,
-                            pp.county, pc.country, pc.latitude, pc.longitude
-                            FROM
-                            (SELECT DISTINCT price, date_of_transfer, postcode, property_type, new_build_flag, tenure_type, locality,
-                            town_city, district, county
-                            FROM pp_data WHERE {pp_condition}
-                            date_of_transfer >= '{start_date}' AND
-                            date_of_transfer <= '{end_date}') pp
-                            INNER JOIN
-                            (SELECT postcode, country, latitude, longitude FROM postcode_data {pc_condition}) pc
-                            ON pp.postcode = pc.postcode""")
-            rows = cur.fetchall()
-
-            with open(path.join(tables, filename), 'w', newline='') as file:
-                writer = csv.writer(file, delimiter=',', doublequote=False, lineterminator='\n',
-                                    quoting=csv.QUOTE_MINIMAL)
-                for row in rows:
-                    writer.writerow(row)
-            return rows, False
 
+def tag_mask(gdf, tag):
+    mask = pd.Series(False, index=gdf.index)
+    for key, values in tag.items():
+        if key in gdf:
+            mask |= gdf[key].notna() if values is True else \
+                gdf[key].isin(values if isinstance(values, list) else [values])
+    return mask
 
-def road_data(north, south, east, west, network_type, custom_filter):
-    _, edges = ox.graph_to_gdfs(ox.graph_from_bbox(north, south, east, west,
-                                                   network_type=network_type,
-                                                   truncate_by_edge=True,
-                                                   custom_filter=custom_filter))
-    return edges
+
+def fetch_combined_pois(tags):
+    return fetch_pois_data(merge_tags(tags))
+
+
+def select_pois(pois, tag):
+    # Keeps only the tag's own columns, so a category's tiles look the same whichever query fetched them
+    return pois.loc[tag_mask(pois, tag), [key for key in tag if key in pois] + ['geometry']]
 
 
+@trace.traced('osm pois')
 def pois_data(north, south, east, west, tags):
-    tag_gdfs = []
-    for tag in tags:
-        tag_gdf = ox.geometries_from_bbox(north, south, east, west, tag[1])
-        tag_gdf['display name'] = tag[0]
-        tag_gdfs.append(tag_gdf)
-    return tag_gdfs
+    tags = list(tags)
+    try:
+        tag_gdfs = cache.osm_data_many('pois', [tag for _, tag in tags], fetch_combined_pois, select_pois,
+                                       north, south, east, west)
+    except Exception as e:
+        trace.progress(f"Combined POI query failed ({e}), fetching each tag separately...\n")
+        fetch = trace.bind(lambda tag: cache.osm_data('pois', tag, fetch_pois_data(tag), north, south, east, west))
+        with ThreadPoolExecutor(config.get('poi_workers', 4)) as fetches:
+            tag_gdfs = list(fetches.map(fetch, [tag for _, tag in tags]))
+
+    names = np.repeat([name for name, _ in tags], [len(tag_gdf) for tag_gdf in tag_gdfs])
+    pois = pd.concat(tag_gdfs) if tag_gdfs else gpd.GeoDataFrame(geometry=gpd.GeoSeries([], crs=4326))
+    pois['display name'] = names
+    return pois
 
 
 def init():
     create_directories()
+    if config.get('backend', 'mariadb') == 'duckdb':
+        build_local_database()
+        trace.progress('Finished initialisation\n')
+        return
     initialize_database()
     upload_price_paid_data()
     upload_postcode_data()
-    print('Finished initialisation\n')
+    build_indexes()
+    trace.progress('Finished initialisation\n')
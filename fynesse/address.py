@@ -1,40 +1,283 @@
+from .config import *
 from . import assess
+from . import cache
+from . import trace
+from .utils import *
+from .lazy import lazy
 
-import random
+import time
 import numpy as np
-import sklearn
-from IPython.display import display
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+pd = lazy('pandas')
+sklearn = lazy('sklearn', 'sklearn.linear_model')
+display = lazy('IPython.display', attribute='display')
+cKDTree = lazy('scipy.spatial', attribute='cKDTree')
+
+model_metrics = {'hits': 0, 'updates': 0, 'refits': 0}
 
 
 def predict_price(latitude, longitude, date, property_type):
+    if config.get('use_model_store', False):
+        return predict_price_stored(latitude, longitude, date, property_type)
     return predict_price_spec(latitude, longitude, date, property_type)
 
 
-def predict_price_spec(latitude, longitude, date, property_type, boxsize=0.05, radius=0.03, half_days=1800, sample_size=100):
+@trace.traced()
+def predict_price_spec(latitude, longitude, date, property_type, boxsize=0.05, radius=0.03, half_days=1800, folds=5):
     model = sklearn.linear_model.LinearRegression(fit_intercept=False)
 
+    start = time.time()
     labelled_data = assess.labelled(latitude, longitude, date, property_type, boxsize, radius, half_days)
+    timings = {'features': time.time() - start}
 
-    model.fit(labelled_data[0][:-1], labelled_data[1])
+    start = time.time()
+    with trace.span('fit') as fitted:
+        model.fit(labelled_data[0][:-1], labelled_data[1])
+        fitted.add(rows=len(labelled_data[1]))
+    timings['fit'] = time.time() - start
     coef = model.coef_
     print("Fitted model coefficients:\n")
     print(coef.reshape(-1, 1))
 
-    squared_sum = 0
-    for _ in range(0, sample_size):
-        rand = random.randrange(0, labelled_data[0].shape[0] - 1)
-        predicted_price = int(round(model.predict(labelled_data[0][rand].reshape(1, -1))[0], -3))
-        real_price = labelled_data[1][rand]
-        squared = ((predicted_price - real_price) / 100000) ** 2
-        squared_sum += squared
-
-    print(f"\nAverage {sample_size} normalised squared residuals: \t{squared_sum / sample_size:.2f}")
+    metrics, evaluation_timings = evaluate_model(labelled_data[0][:-1], labelled_data[1], labelled_data[5][:-1],
+                                                 folds=folds, seed=config.get('evaluation_seed', 0))
+    timings.update(evaluation_timings)
+    print("\nModel evaluation:\n")
+    display(metrics)
+    trace.progress("\nTimings (s): \t" + ", ".join(f"{stage} {seconds:.3f}" for stage, seconds in timings.items()))
 
     print("\nPredicted property price:\n")
     [pred] = model.predict(labelled_data[0][-1].reshape(1, -1))
     print(int(pred))
-    if len(labelled_data[0][:-1]) < 100 or squared_sum / sample_size > 100:
+    if len(labelled_data[0][:-1]) < 100 or not (metrics.loc['All', ('cross-validation', 'rmse')] / 100000) ** 2 <= 100:
         print("\nQuality of model is poor.\n")
 
     return int(pred)
 
+
+def fold_predictions(xtx, xty, design, prices):
+    # Downdating the full statistics by the held-out rows fits the fold without revisiting the other rows
+    coef = np.linalg.lstsq(xtx - design.T @ design, xty - design.T @ prices, rcond=None)[0]
+    return design @ coef
+
+
+def error_metrics(predicted, prices, ptype):
+    errors = pd.DataFrame({'property type': ptype, 'squared': np.square(predicted - prices),
+                           'relative': np.abs(predicted - prices) / prices})
+    grouped = errors.groupby('property type')
+    metrics = pd.DataFrame({'rows': grouped.size(), 'rmse': np.sqrt(grouped['squared'].mean()),
+                            'mape': grouped['relative'].mean()})
+    metrics.loc['All'] = [len(errors), np.sqrt(errors['squared'].mean()), errors['relative'].mean()]
+    return metrics
+
+
+@trace.traced()
+def evaluate_model(design, prices, ptype, folds=5, holdout=0.2, workers=None, seed=None):
+    prices = np.asarray(prices, dtype='float64')
+    ptype = np.asarray(ptype)
+    order = np.random.default_rng(seed).permutation(len(prices))
+    timings = {}
+
+    start = time.time()
+    split = int(len(order) * holdout)
+    test, train = order[:split], order[split:]
+    coef = np.linalg.lstsq(design[train], prices[train], rcond=None)[0]
+    holdout_metrics = error_metrics(design[test] @ coef, prices[test], ptype[test])
+    timings['holdout'] = time.time() - start
+
+    start = time.time()
+    xtx, xty = design.T @ design, design.T @ prices
+    splits = np.array_split(order, folds)
+    workers = config.get('evaluation_workers', 1) if workers is None else workers
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as pool:
+            fold_results = list(pool.map(fold_predictions, repeat(xtx), repeat(xty),
+                                         [design[fold] for fold in splits], [prices[fold] for fold in splits]))
+    else:
+        fold_results = [fold_predictions(xtx, xty, design[fold], prices[fold]) for fold in splits]
+    predicted = np.empty_like(prices)
+    for fold, result in zip(splits, fold_results):
+        predicted[fold] = result
+    cv_metrics = error_metrics(predicted, prices, ptype)
+    timings['cross-validation'] = time.time() - start
+
+    return pd.concat({'holdout': holdout_metrics, 'cross-validation': cv_metrics}, axis=1), timings
+
+
+def fit_targets(design, prices, lats, lons, days, target_lats, target_lons, target_days, boxsize, half_days):
+    # Rows past len(prices) are the targets; each target is fitted on its own box and date window, as
+    # predict_price_spec does, but from the shared design matrix. The POI box covers the radius around every
+    # row, so the features, and with them the fits, match predict_price_spec up to rounding
+    half = boxsize / 2
+    n = len(prices)
+    results = []
+    for k in range(len(target_lats)):
+        mask = (lats >= target_lats[k] - half) & (lats < target_lats[k] + half) & \
+               (lons >= target_lons[k] - half) & (lons < target_lons[k] + half) & \
+               (days >= target_days[k] - half_days) & (days <= target_days[k] + half_days)
+        x = design[:n][mask]
+        if not len(x):
+            results.append((np.nan, 0, np.nan))
+            continue
+        coef = np.linalg.lstsq(x, prices[mask], rcond=None)[0]
+        residuals = np.mean(np.square((x @ coef - prices[mask]) / 100000))
+        results.append((int(design[n + k] @ coef), len(x), residuals))
+    return results
+
+
+@trace.traced()
+def group_features(targets, boxsize, radius, half_days):
+    half = boxsize / 2
+    lat_min, lat_max = targets['latitude'].min() - half, targets['latitude'].max() + half
+    lon_min, lon_max = targets['longitude'].min() - half, targets['longitude'].max() + half
+    start_date = add_days(targets['date'].min(), -half_days)
+    end_date = min(add_days(targets['date'].max(), half_days), str(this_year)+'-12-31')
+
+    df = assess.box_prices_data(lat_min, lat_max, lon_min, lon_max, start_date, end_date,
+                                columns=['price', 'date of transfer', 'property type', 'latitude', 'longitude'])
+
+    normalized_year = np.append(normalize_year(df['date of transfer']), normalize_year(targets['date']))
+    ptype = np.append(df['property type'], targets['property type'].map(property_type_map))
+    lats = np.append(df['latitude'], targets['latitude'])
+    lons = np.append(df['longitude'], targets['longitude'])
+
+    properties = assess.property_points(lats, lons)
+    pois = assess.poi_indexes(*assess.poi_box(lat_min, lat_max, lon_min, lon_max, radius))
+
+    return (assess.design_matrix(normalized_year, ptype, properties, pois, radius), df['price'].to_numpy(),
+            df['latitude'].to_numpy(), df['longitude'].to_numpy(),
+            to_days(df['date of transfer']).astype('int64'),
+            targets['latitude'].to_numpy(), targets['longitude'].to_numpy(),
+            to_days(targets['date']).astype('int64'), boxsize, half_days)
+
+
+def predict_group(targets, boxsize, radius, half_days):
+    return fit_targets(*group_features(targets, boxsize, radius, half_days))
+
+
+@trace.traced()
+def predict_prices(frame, boxsize=0.05, radius=0.03, half_days=1800, workers=None):
+    targets = pd.DataFrame({'latitude': frame['latitude'].astype('float64').to_numpy(),
+                            'longitude': frame['longitude'].astype('float64').to_numpy(),
+                            'date': pd.to_datetime(frame['date']).dt.strftime('%Y-%m-%d').to_numpy(),
+                            'property type': frame['property type'].to_numpy()})
+    # Targets sharing a grid cell share one data fetch, one set of POI indexes and one design matrix
+    size = config.get('predict_group_size', 0.1)
+    groups = targets.groupby([cache.tile_index(targets['latitude'], size),
+                              cache.tile_index(targets['longitude'], size)]).indices
+
+    trace.progress(f"Predicting {len(targets)} prices in {len(groups)} groups...\n")
+
+    predictions = np.full(len(targets), np.nan)
+    training_rows = np.zeros(len(targets), dtype='int64')
+    residuals = np.full(len(targets), np.nan)
+    group_ids = np.zeros(len(targets), dtype='int64')
+    # Groups run on threads: fetching, reprojection and KD-tree queries dominate, and they wait on the
+    # database, OpenStreetMap or numpy and scipy code that releases the GIL
+    predict = trace.bind(predict_group)
+    with ThreadPoolExecutor(workers or config.get('predict_workers')) as pool:
+        futures = []
+        for group_id, rows in enumerate(groups.values()):
+            group_ids[rows] = group_id
+            futures.append((rows, pool.submit(predict, targets.iloc[rows], boxsize, radius, half_days)))
+        for rows, future in futures:
+            for row, (prediction, n, residual) in zip(rows, future.result()):
+                predictions[row] = prediction
+                training_rows[row] = n
+                residuals[row] = residual
+
+    result = frame.copy()
+    result['predicted price'] = predictions
+    result['training rows'] = training_rows
+    result['normalised squared residuals'] = residuals
+    result['poor quality'] = (training_rows < 100) | ~(residuals <= 100)
+    result['group'] = group_ids
+    return result
+
+
+def model_region(latitude, longitude, date, boxsize, radius, half_days):
+    # Models cover one boxsize grid cell and one model_window_days slice of time, trained on
+    # transactions in the cell up to half_days either side of the slice
+    window = config.get('model_window_days', 365)
+    i = int(cache.tile_index(float(latitude), float(boxsize)))
+    j = int(cache.tile_index(float(longitude), float(boxsize)))
+    bucket = int((to_days(date) - day_zero_day).astype('int64')) // window
+    start_date = add_days(str(day_zero_day + bucket * window), -half_days)
+    end_date = add_days(str(day_zero_day + (bucket + 1) * window - 1), half_days)
+    end_date = end_date if comp_date(end_date, str(this_year)+'-12-31') else str(this_year)+'-12-31'
+    box = (cache.tile_bound(i, boxsize), cache.tile_bound(i + 1, boxsize),
+           cache.tile_bound(j, boxsize), cache.tile_bound(j + 1, boxsize))
+    key = f"{i}#{j}#{bucket}#{boxsize}#{radius}#{half_days}#{cache.osm_selector_key(config['poi_map'])}"
+    return key, box, start_date, end_date
+
+
+def region_statistics(df, pois, radius):
+    design = assess.design_matrix(normalize_year(df['date of transfer']), df['property type'].to_numpy(),
+                                  assess.property_points(df['latitude'], df['longitude']), pois, radius)
+    prices = df['price'].to_numpy(dtype='float64')
+    return design.T @ design, design.T @ prices, prices @ prices, len(prices)
+
+
+@trace.traced()
+def stored_model(latitude, longitude, date, boxsize, radius, half_days):
+    key, box, start_date, end_date = model_region(latitude, longitude, date, boxsize, radius, half_days)
+    version = cache.data_version()
+    model = cache.load_model(key)
+    if model is not None and model['version'] == version:
+        model_metrics['hits'] += 1
+        trace.current().hit()
+        return model
+    trace.current().miss()
+
+    radius = Decimal(str(radius))
+    columns = ['price', 'date of transfer', 'property type', 'latitude', 'longitude']
+    # Without a delta for every load since the fit (or if the manifest was reset) the model is refitted
+    deltas = None if model is None else cache.deltas_since(int(model['version']))
+    if deltas:
+        model_metrics['updates'] += 1
+        pois = [cKDTree(model[f'poi_{k}']) for k in range(len(config['poi_map']))]
+        df = cache.read_table(deltas, columns=columns, start_date=start_date, end_date=end_date,
+                              lat_min=box[0], lat_max=box[1], lon_min=box[2], lon_max=box[3])
+        df['property type'] = df['property type'].map(property_type_map)
+        xtx, xty, yty, n = region_statistics(df, pois, radius)
+        xtx, xty, yty, n = model['xtx'] + xtx, model['xty'] + xty, model['yty'] + yty, model['n'] + n
+    else:
+        model_metrics['refits'] += 1
+        pois = assess.poi_indexes(*assess.poi_box(*box, radius))
+        df = assess.box_prices_data(*box, start_date, end_date, columns=columns)
+        xtx, xty, yty, n = region_statistics(df, pois, radius)
+
+    coef = np.linalg.lstsq(xtx, xty, rcond=None)[0]
+    model = {'xtx': xtx, 'xty': xty, 'yty': yty, 'n': n, 'coef': coef, 'version': version,
+             **{f'poi_{k}': poi.data for k, poi in enumerate(pois)}}
+    cache.save_model(key, **model)
+    return model
+
+
+@trace.traced()
+def predict_price_stored(latitude, longitude, date, property_type, boxsize=0.05, radius=0.03, half_days=1800):
+    model = stored_model(latitude, longitude, date, boxsize, radius, half_days)
+
+    pois = [cKDTree(model[f'poi_{k}']) for k in range(len(config['poi_map']))]
+    design = assess.design_matrix(normalize_year([date]), np.array([property_type_map[property_type]]),
+                                  assess.property_points([float(latitude)], [float(longitude)]), pois,
+                                  Decimal(str(radius)))
+    [pred] = design @ model['coef']
+
+    # In-sample residuals follow from the sufficient statistics without revisiting the data. They are optimistic
+    # next to predict_price_spec's held-out metrics, as the store keeps no holdout
+    coef, n = model['coef'], int(model['n'])
+    residuals = (model['yty'] - 2 * coef @ model['xty'] + coef @ model['xtx'] @ coef) / max(n, 1) / 10 ** 10
+
+    trace.progress(f"Model store: {model_metrics['hits']} hits, {model_metrics['updates']} incremental updates, "
+                   f"{model_metrics['refits']} refits\n")
+    print(f"In-sample average normalised squared residuals: \t{residuals:.2f}")
+
+    print("\nPredicted property price:\n")
+    print(int(pred))
+    if n < 100 or residuals > 100:
+        print("\nQuality of model is poor.\n")
+
+    return int(pred)
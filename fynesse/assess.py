@@ -1,55 +1,191 @@
 from .config import *
 from . import access
+from . import cache
+from . import trace
 from .utils import *
+from .lazy import lazy
 
-from matplotlib import pyplot as plt
-from IPython.display import display
 import numpy as np
-import pandas as pd
-import geopandas as gpd
-import ipywidgets as widgets
+import logging
+import threading
 from os import path
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+Figure = lazy('matplotlib.figure', attribute='Figure')
+colormaps = lazy('matplotlib', attribute='colormaps')
+LogNorm = lazy('matplotlib.colors', attribute='LogNorm')
+display = lazy('IPython.display', attribute='display')
+pd = lazy('pandas')
+gpd = lazy('geopandas')
+widgets = lazy('ipywidgets')
 
 figure = None
 graph = None
+session_cache = OrderedDict()
+session_lock = threading.Lock()
+session_version = None
+view_state = threading.local()
+
+
+def session_cached(key, fetch):
+    global session_version
+    with session_lock:
+        # Anything loaded into the database since the last call makes the held frames stale
+        if session_version != cache.data_version():
+            session_cache.clear()
+            session_version = cache.data_version()
+        if key in session_cache:
+            trace.current().hit()
+            session_cache.move_to_end(key)
+            return session_cache[key]
+    trace.current().miss()
+    value = fetch()
+    with session_lock:
+        session_cache[key] = value
+        while len(session_cache) > config.get('session_cache_size', 16):
+            session_cache.popitem(last=False)
+    return value
+
+
+class Cancelled(Exception):
+    pass
+
+
+def checkpoint():
+    # Called between the stages of a view, so one running under BackgroundView stops once a newer one is submitted
+    view = getattr(view_state, 'view', None)
+    if view is not None and view[1] != view[0].generation:
+        raise Cancelled()
+
+
+class OutputHandler(logging.Handler):
+    # Sends the progress messages of the view a BackgroundView is running to its output widget.
+    # append_stdout is safe from the worker thread, where entering the Output context is not
+    def __init__(self, background):
+        super().__init__()
+        self.background = background
+
+    def emit(self, record):
+        view = getattr(view_state, 'view', None)
+        if view is not None and view[0] is self.background and view[1] == self.background.generation:
+            self.background.output.append_stdout(self.format(record) + '\n')
+
+
+class BackgroundView:
+    # Runs views one at a time off the kernel thread. A newer submission cancels older ones: they are
+    # skipped if still queued and stop at their next checkpoint() if already running
+    def __init__(self, output):
+        self.output = output
+        self.worker = ThreadPoolExecutor(1)
+        self.generation = 0
+        self.handler = OutputHandler(self)
+
+    def submit(self, view, done):
+        self.generation += 1
+        self.output.outputs = ()
+        self.output.append_stdout('Loading...\n')
+        return self.worker.submit(self.run, self.generation, view, done)
+
+    def run(self, generation, view, done):
+        if generation != self.generation:
+            return None
+        view_state.view = (self, generation)
+        trace.progress_logger.addHandler(self.handler)
+        try:
+            with trace.captured():
+                fig = view()
+        except Cancelled:
+            return None
+        except Exception as e:
+            if generation == self.generation:
+                self.output.outputs = ()
+                self.output.append_stdout(f"{e}\n")
+            return None
+        finally:
+            trace.progress_logger.removeHandler(self.handler)
+            view_state.view = None
+        if generation == self.generation:
+            done(fig)
+            self.output.outputs = ()
+            self.output.append_display_data(fig)
+        return fig
+
+
+def table_bounds(latitude=None, longitude=None, boxsize='0.1', start_date=None, end_date=None):
+    bounds = {'start_date': start_date, 'end_date': end_date}
+    if latitude is not None and longitude is not None:
+        half = Decimal(0.5)
+        latitude = Decimal(latitude)
+        longitude = Decimal(longitude)
+        boxsize = Decimal(boxsize)
+        bounds.update(lat_min=latitude - half * boxsize, lat_max=latitude + half * boxsize,
+                      lon_min=longitude - half * boxsize, lon_max=longitude + half * boxsize)
+    return bounds
 
 
+@trace.traced('prices')
 def prices_coordinates_data(area_type='town_city', area_name='CAMBRIDGE', outcode=None, latitude=None, longitude=None, boxsize='0.1',
-                            start_date='2013-01-01', end_date=str(this_year)+'-12-31'):
-    data, loaded_locally = access.prices_coordinates_data(area_type, area_name, outcode, latitude, longitude,
-                                                          boxsize, start_date, end_date)
-    if loaded_locally:
-        df = pd.read_csv(data, names=table_column_list, converters={'latitude': Decimal, 'longitude': Decimal})
-        df = df.loc[df['date of transfer'].map(lambda d: comp_date(start_date, d) and comp_date(d, end_date))]
-        if latitude is not None and longitude is not None:
-            half = Decimal(0.5)
-            latitude = Decimal(latitude)
-            longitude = Decimal(longitude)
-            boxsize = Decimal(boxsize)
-            df = df.loc[(df['latitude'] >= latitude - half * boxsize) & (df['latitude'] < latitude + half * boxsize) &
-                        (df['longitude'] >= longitude - half * boxsize) & (df['longitude'] < longitude + half * boxsize)]
-    else:
-        df = pd.DataFrame(data, columns=table_column_list)
-    df['property type'] = df['property type'].map(property_type_map)
+                            start_date='2013-01-01', end_date=str(this_year)+'-12-31', columns=None):
+    data = access.prices_coordinates_data(area_type, area_name, outcode, latitude, longitude,
+                                          boxsize, start_date, end_date)
+    df = cache.read_table(data, columns=columns, **table_bounds(latitude, longitude, boxsize, start_date, end_date))
+    if 'property type' in df:
+        df['property type'] = df['property type'].map(property_type_map)
     return df
 
 
+def iter_prices_coordinates_data(area_type='town_city', area_name='CAMBRIDGE', outcode=None, latitude=None, longitude=None,
+                                 boxsize='0.1', start_date='2013-01-01', end_date=str(this_year)+'-12-31', columns=None,
+                                 chunk_size=None):
+    data = access.prices_coordinates_data(area_type, area_name, outcode, latitude, longitude,
+                                          boxsize, start_date, end_date)
+    for chunk in cache.iter_table(data, columns=columns, chunk_size=chunk_size,
+                                  **table_bounds(latitude, longitude, boxsize, start_date, end_date)):
+        if 'property type' in chunk:
+            chunk['property type'] = chunk['property type'].map(property_type_map)
+        yield chunk
+
+
 def road_data(north, south, east, west, network_type, custom_filter):
     data = access.road_data(north, south, east, west, network_type, custom_filter)
     data["color"] = data["highway"].map(lambda x: x[0] if isinstance(x, list) else x).map(road_color_map).fillna("dimgray")
     return data
 
 
-def pois_data(north, south, east, west, tags):
-    data = access.pois_data(north, south, east, west, tags)
-    pois = gpd.GeoDataFrame(pd.concat(data, ignore_index=True))
-    pois['geometry'] = pois['geometry'].to_crs(27700).centroid
-    pois['geometry'] = pois['geometry'].to_crs(4326)
-    return pois
-
-
-def view_map(df, tags, display_name, display_size=15, latitude=None, longitude=None, boxsize='0.1', lod=3):
-    print('Retrieving road data...\n')
+@trace.traced('pois')
+def pois_data(north, south, east, west, tags, crs=4326):
+    pois = access.pois_data(north, south, east, west, tags).reset_index(drop=True)
+    pois = pois.set_geometry(pois.geometry.to_crs(27700).centroid)
+    return pois if crs == 27700 else pois.to_crs(crs)
+
+
+def raster_prices(df, north, south, east, west, cells):
+    # One geometric mean price layer per entry of property_types_list, then a last layer over every type
+    size = max(east - west, north - south) / cells
+    nx = max(int(np.ceil((east - west) / size)), 1)
+    ny = max(int(np.ceil((north - south) / size)), 1)
+    x = np.floor((df['longitude'].to_numpy() - west) / size).astype('int64')
+    y = np.floor((df['latitude'].to_numpy() - south) / size).astype('int64')
+    types = pd.Categorical(df['property type'], categories=property_types_list).codes.astype('int64')
+    inside = (x >= 0) & (x < nx) & (y >= 0) & (y < ny) & (types >= 0)
+    cell = (types[inside] * ny + y[inside]) * nx + x[inside]
+
+    layers = len(property_types_list) * nx * ny
+    counts = np.bincount(cell, minlength=layers).reshape(-1, ny, nx)
+    log_prices = np.bincount(cell, weights=np.log(df['price'].to_numpy()[inside]), minlength=layers).reshape(-1, ny, nx)
+    counts = np.concatenate([counts, counts.sum(axis=0, keepdims=True)])
+    log_prices = np.concatenate([log_prices, log_prices.sum(axis=0, keepdims=True)])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        prices = np.exp(log_prices / counts)
+    return np.ma.masked_invalid(prices), (west, west + nx * size, south, south + ny * size)
+
+
+@trace.traced('render map')
+def view_map(df, tags, display_name, display_size=15, latitude=None, longitude=None, boxsize='0.1', lod=3,
+             aggregate=None, property_type=None, show=True):
+    checkpoint()
+    trace.progress('Retrieving road data...\n')
 
     if latitude is None or longitude is None:
         lat_min = df['latitude'].min()
@@ -59,17 +195,17 @@ def view_map(df, tags, display_name, display_size=15, latitude=None, longitude=N
 
         width = lon_max - lon_min
         height = lat_max - lat_min
-        tenth = Decimal(0.1)
+        tenth = 0.1
 
         north = lat_max + tenth * height
         south = lat_min - tenth * height
         east = lon_max + tenth * width
         west = lon_min - tenth * width
     else:
-        half = Decimal(0.5)
-        latitude = Decimal(latitude)
-        longitude = Decimal(longitude)
-        boxsize = Decimal(boxsize)
+        half = 0.5
+        latitude = float(latitude)
+        longitude = float(longitude)
+        boxsize = float(boxsize)
         width = boxsize
         height = boxsize
 
@@ -78,11 +214,12 @@ def view_map(df, tags, display_name, display_size=15, latitude=None, longitude=N
         east = longitude + half * width
         west = longitude - half * width
 
-    gdf = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.longitude, df.latitude))
     scaling_factor = 0.0081 / float(width * height) * display_size * 0.25
-    gdf['marker size'] = np.power(gdf['price'] / 100000, 2) * scaling_factor
+    if aggregate is None:
+        aggregate = len(df) > config.get('map_point_limits', {}).get(lod, 50000)
 
-    fig, ax = plt.subplots(figsize=(display_size, display_size))
+    fig = Figure(figsize=(display_size, display_size))
+    ax = fig.subplots()
 
     # Plot road edges
     if lod == 3:
@@ -94,7 +231,9 @@ def view_map(df, tags, display_name, display_size=15, latitude=None, longitude=N
     else:
         network_type = "drive"
         custom_filter = '["highway"~"motorway|trunk|primary|secondary|tertiary|motorway_link|trunk_link|primary_link|secondary_link|tertiary_link"]'
-    edges = road_data(north, south, east, west, network_type=network_type, custom_filter=custom_filter)
+    edges = session_cached(('roads', north, south, east, west, network_type, custom_filter),
+                           lambda: road_data(north, south, east, west, network_type=network_type,
+                                             custom_filter=custom_filter))
     edges.plot(ax=ax, linewidth=1, edgecolor=edges["color"])
 
     ax.set_xlim([west, east])
@@ -103,42 +242,65 @@ def view_map(df, tags, display_name, display_size=15, latitude=None, longitude=N
     ax.set_ylabel("latitude", fontsize=14)
     ax.set_title(display_name, fontsize=18)
 
-    gdf.plot(ax=ax, alpha=0.2, markersize=gdf['marker size'], column="property type", cmap="viridis", categorical=True,
-             categories=['Detached', 'Semi-detached', 'Terraced', 'Flat/Maisonettes', 'Others'],
-             legend=True, legend_kwds={'loc': 'upper right'})
+    if aggregate:
+        # Binning into a fixed grid keeps drawing time flat however many sales are in the area
+        # property_type picks one type's layer, None shows every type together. Points already show types by colour
+        prices, extent = raster_prices(df, north, south, east, west, config.get('map_grid_cells', 150))
+        layer = len(property_types_list) if property_type is None else property_types_list.index(property_type)
+        sales = df if property_type is None else df.loc[df['property type'] == property_type]
+        image = ax.imshow(prices[layer], extent=extent, origin='lower', cmap='viridis', norm=LogNorm(), alpha=0.7,
+                          interpolation='nearest', zorder=2)
+        kind = '' if property_type is None else property_type.lower() + ' '
+        fig.colorbar(image, ax=ax, shrink=0.5, label=f"geometric mean price of {len(sales)} {kind}sales")
+    else:
+        gdf = gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.longitude, df.latitude))
+        gdf['marker size'] = np.power(gdf['price'] / 100000, 2) * scaling_factor
+        gdf['property type'] = gdf['property type'].astype(object)
+        gdf.plot(ax=ax, alpha=0.2, markersize=gdf['marker size'], column="property type", cmap="viridis",
+                 categorical=True, categories=property_types_list,
+                 legend=True, legend_kwds={'loc': 'upper right'})
     legend = ax.get_legend()
 
     if tags:
-        print('Retrieving POIs...\n')
-        pois = pois_data(north, south, east, west, tags)
-        print("{number} POIs found in the surrounding area of {display_name} ({width:.1f}km x {height:.1f}km)\n".format(
-              display_name=display_name, number=len(pois), width=width * degree, height=height * degree))
+        checkpoint()
+        trace.progress('Retrieving POIs...\n')
+        pois = session_cached(('pois', north, south, east, west, tuple(name for name, _ in tags)),
+                              lambda: pois_data(north, south, east, west, tags))
+        trace.progress("{number} POIs found in the surrounding area of {display_name} ({width:.1f}km x {height:.1f}km)\n".format(
+              display_name=display_name, number=len(pois), width=width * float(degree), height=height * float(degree)))
         pois.plot(ax=ax, markersize=np.maximum(25, 5 * scaling_factor), marker="^", column="display name",
                   cmap="rainbow", categorical=True, categories=config['poi_map'].keys(),
                   legend=True, legend_kwds={'loc': 'upper left'})
-        ax.add_artist(legend)
+        if legend is not None:
+            ax.add_artist(legend)
 
-    print('Plotting map...\n')
+    checkpoint()
+    trace.progress('Plotting map...\n')
     ax.set_aspect('equal')
     ax.text(1, -0.04, '© Crown copyright and database right 2021, Royal Mail copyright and database right 2022, OpenStreetMap contributors', horizontalalignment='right', verticalalignment='top', transform=ax.transAxes)
     fig.tight_layout()
-    plt.close()
 
-    display(fig)
+    if show:
+        display(fig)
     return fig
 
 
+@trace.traced()
 def view_queried_map(year_range, price_range, property_types, pois, display_name, display_size, lod,
-                     area_type=None, area_name=None, outcode=None, latitude=None, longitude=None, boxsize=None):
-    df = prices_coordinates_data(start_date=str(year_range[0]) + "-01-01", end_date=str(year_range[1])+"-12-31",
-                                 area_type=area_type, area_name=area_name, outcode=outcode,
-                                 latitude=latitude, longitude=longitude, boxsize=boxsize)
+                     area_type=None, area_name=None, outcode=None, latitude=None, longitude=None, boxsize=None,
+                     property_type=None, show=True):
+    # Price, type and display changes reuse the frame held in memory and only re-filter and re-render
+    df = session_cached(('map', tuple(year_range), area_type, area_name, outcode, latitude, longitude, boxsize),
+                        lambda: prices_coordinates_data(start_date=str(year_range[0]) + "-01-01",
+                                                        end_date=str(year_range[1])+"-12-31",
+                                                        area_type=area_type, area_name=area_name, outcode=outcode,
+                                                        latitude=latitude, longitude=longitude, boxsize=boxsize))
     df = df.loc[(df["price"] >= price_range[0]) & (df["price"] <= price_range[1])]
     df = df.loc[df["property type"].isin(property_types)]
-    if df.empty:
+    if df.empty or (property_type is not None and not (df["property type"] == property_type).any()):
         raise Exception('No property price data is available for this configuration')
     return view_map(df, tags=pois, display_name=display_name, display_size=display_size, lod=lod,
-                    latitude=latitude, longitude=longitude, boxsize=boxsize)
+                    latitude=latitude, longitude=longitude, boxsize=boxsize, property_type=property_type, show=show)
 
 
 def view_interactive_map():
@@ -194,7 +356,11 @@ def view_interactive_map():
     points_of_interest = widgets.SelectMultiple(options=config['poi_map'].keys(), description="Points of interest:",
                                                 style={'description_width': 'initial'},
                                                 layout=widgets.Layout(width='400px'))
-    select_multiples = widgets.HBox([property_types, points_of_interest], layout=widgets.Layout(grid_gap='10px'))
+    # Large areas are drawn as a price raster, of one property type or of all selected types together
+    raster_type = widgets.Dropdown(options=['All selected'] + property_types_list, description="Raster type:",
+                                   style={'description_width': 'initial'})
+    select_multiples = widgets.HBox([property_types, points_of_interest, raster_type],
+                                    layout=widgets.Layout(grid_gap='10px'))
 
     display(year_range)
     display(price_range)
@@ -204,21 +370,23 @@ def view_interactive_map():
     save_button = widgets.Button(description="Save")
 
     def view_clicked(_):
-        output.clear_output()
-        with output:
-            try:
-                pois = [(p, config['poi_map'][p]) for p in points_of_interest.value]
-                global figure
-                figure = view_queried_map(year_range.value, price_range.value, property_types.value, pois,
-                                          display_name.value, display_size.value, lod.value,
-                                          area_type=None if area_name.disabled else type_map[area_type.value],
-                                          area_name=None if area_name.disabled else area_name.value.upper(),
-                                          outcode=None if outcode.disabled else outcode.value.upper(),
-                                          latitude=None if latitude.disabled else latitude.value,
-                                          longitude=None if longitude.disabled else longitude.value,
-                                          boxsize=None if boxsize.disabled else boxsize.value)
-            except Exception as e:
-                print(e)
+        # Widget values are read here on the kernel thread, the query and plot run in the background
+        args = (year_range.value, price_range.value, property_types.value,
+                [(p, config['poi_map'][p]) for p in points_of_interest.value],
+                display_name.value, display_size.value, lod.value)
+        kwargs = dict(area_type=None if area_name.disabled else type_map[area_type.value],
+                      area_name=None if area_name.disabled else area_name.value.upper(),
+                      outcode=None if outcode.disabled else outcode.value.upper(),
+                      latitude=None if latitude.disabled else latitude.value,
+                      longitude=None if longitude.disabled else longitude.value,
+                      boxsize=None if boxsize.disabled else boxsize.value,
+                      property_type=None if raster_type.value == 'All selected' else raster_type.value)
+
+        def done(fig):
+            global figure
+            figure = fig
+
+        background.submit(lambda: view_queried_map(*args, **kwargs, show=False), done)
 
     def save_clicked(_):
         with output:
@@ -248,20 +416,87 @@ def view_interactive_map():
     display(buttons)
     output = widgets.Output()
     display(output)
-
-
+    background = BackgroundView(output)
+
+
+@trace.traced('percentiles')
+def price_percentiles(df, year_range, property_types):
+    df = df.loc[df['property type'].isin(property_types)]
+    grouped = df['price'].groupby([df['property type'].astype(str).rename('property type'),
+                                   df['date of transfer'].dt.year.rename('year')])
+    table = grouped.quantile([0.25, 0.5, 0.75]).unstack()
+    table.columns = ['25%', '50%', '75%']
+    table['count'] = grouped.size()
+    index = pd.MultiIndex.from_product([list(property_types), range(year_range[0], year_range[1] + 1)],
+                                       names=['property type', 'year'])
+    return table.reindex(index).reset_index()
+
+
+@trace.traced('percentiles')
+def rollup_percentiles(rollups, year_range, property_types):
+    gamma = access.rollup_gamma()
+    rollups = rollups.assign(**{'property type': rollups['property type'].map(property_type_map)})
+    rollups = rollups.loc[rollups['property type'].isin(property_types)]
+    rollups = rollups.sort_values(['property type', 'year', 'bucket'], ignore_index=True)
+    groups = rollups.groupby(['property type', 'year'])
+    cumulative = groups['sales'].cumsum()
+    total = groups['sales'].transform('sum')
+    value = 2 * np.power(gamma, rollups['bucket'].astype('float64')) / (gamma + 1)
+
+    def ranked(rank):
+        # The sale at a rank falls in the first bucket whose cumulative count passes the rank
+        reached = rollups.loc[cumulative > rank]
+        return value[reached.index].groupby([reached['property type'], reached['year']]).first()
+
+    table = pd.DataFrame({'count': groups['sales'].sum()})
+    for q, column in zip([0.25, 0.5, 0.75], ['25%', '50%', '75%']):
+        # Interpolating between the sales either side of the rank matches np.quantile's linear definition used
+        # by price_percentiles, and keeps each quantile within rollup_accuracy of it
+        rank = q * (total - 1)
+        below, above = ranked(np.floor(rank)), ranked(np.ceil(rank))
+        fraction = (rank - np.floor(rank)).groupby([rollups['property type'], rollups['year']]).first()
+        table[column] = below + fraction * (above - below)
+    index = pd.MultiIndex.from_product([list(property_types), range(year_range[0], year_range[1] + 1)],
+                                       names=['property type', 'year'])
+    return table.reindex(index)[['25%', '50%', '75%', 'count']].reset_index()
+
+
+@trace.traced()
 def view_queried_graph(year_range, property_types, display_size,
-                       area_type=None, area_name=None, outcode=None, latitude=None, longitude=None, boxsize=None):
-    df = prices_coordinates_data(start_date=str(year_range[0]) + "-01-01", end_date=str(year_range[1]) + "-12-31",
-                                 area_type=area_type, area_name=area_name, outcode=outcode, latitude=latitude,
-                                 longitude=longitude, boxsize=boxsize)
+                       area_type=None, area_name=None, outcode=None, latitude=None, longitude=None, boxsize=None,
+                       show=True):
+    if (latitude is None or longitude is None) and config.get('use_rollups', True):
+        rollups = session_cached(('rollups', tuple(year_range), area_type, area_name, outcode),
+                                 lambda: access.price_rollups_data(area_type=area_type, area_name=area_name,
+                                                                   outcode=outcode, start_year=year_range[0],
+                                                                   end_year=year_range[1]))
+        if not rollups.empty:
+            percentiles = rollup_percentiles(rollups, year_range, property_types)
+            if percentiles['count'].isna().all():
+                raise Exception('No property price data is available for this configuration')
+            return plot_percentiles(percentiles, year_range, property_types, display_size, show)
+
+    df = session_cached(('graph', tuple(year_range), area_type, area_name, outcode, latitude, longitude, boxsize),
+                        lambda: prices_coordinates_data(start_date=str(year_range[0]) + "-01-01",
+                                                        end_date=str(year_range[1]) + "-12-31",
+                                                        area_type=area_type, area_name=area_name, outcode=outcode,
+                                                        latitude=latitude, longitude=longitude, boxsize=boxsize,
+                                                        columns=['price', 'date of transfer', 'property type']))
     df = df.loc[df["property type"].isin(property_types)]
 
     if df.empty:
         raise Exception('No property price data is available for this configuration')
 
-    print('Plotting graph...\n')
-    fig, ax = plt.subplots(figsize=(display_size, display_size * 0.5))
+    return plot_percentiles(price_percentiles(df, year_range, property_types), year_range, property_types,
+                            display_size, show)
+
+
+@trace.traced('render graph')
+def plot_percentiles(percentiles, year_range, property_types, display_size, show=True):
+    checkpoint()
+    trace.progress('Plotting graph...\n')
+    fig = Figure(figsize=(display_size, display_size * 0.5))
+    ax = fig.subplots()
 
     ax.set_xlabel("year", fontsize=14)
     ax.set_ylabel("price", fontsize=14)
@@ -269,34 +504,27 @@ def view_queried_graph(year_range, property_types, display_size,
     ax.set_title("Price Percentiles by Property Types", fontsize=18)
     ax.set_xlim([year_range[0], year_range[1]])
 
-    type_predicate = (lambda ptype: df['property type'] == ptype)
-    year_predicate = (lambda year: df['date of transfer'].map(
-        lambda d: comp_date(str(year) + '-01-01', d) and comp_date(d, str(year) + '-12-31')))
+    colors = colormaps.get_cmap('viridis')(np.linspace(0, 1, 5))
 
-    type_year_data = [(ptype, [df.loc[type_predicate(ptype) & year_predicate(year)]['price'].to_numpy()
-                               for year in range(year_range[0], year_range[1] + 1)]) for ptype in property_types]
-
-    colors = plt.cm.viridis(np.linspace(0, 1, 5))
-    years = range(year_range[0], year_range[1] + 1)
-
-    for ptype, data in type_year_data:
+    for ptype in property_types:
         color = colors[property_types_list.index(ptype)]
-        quantiles = np.vstack([np.quantile(year, [0.25, 0.5, 0.75]) for year in data]).transpose()
-        ax.plot(years, quantiles[0], color=color, label=ptype + ' 25%',
+        data = percentiles.loc[percentiles['property type'] == ptype]
+        years = data['year']
+        ax.plot(years, data['25%'], color=color, label=ptype + ' 25%',
                 linestyle='-.', alpha=0.5)
-        ax.plot(years, quantiles[1], color=color, label=ptype + ' 50%', marker='o')
-        ax.plot(years, quantiles[2], color=color, label=ptype + ' 75%',
+        ax.plot(years, data['50%'], color=color, label=ptype + ' 50%', marker='o')
+        ax.plot(years, data['75%'], color=color, label=ptype + ' 75%',
                 linestyle='--', alpha=0.5)
-        ax.fill_between(years, quantiles[0], quantiles[2], alpha=0.2, color=color)
+        ax.fill_between(years, data['25%'], data['75%'], alpha=0.2, color=color)
 
     ax.legend(loc='upper left', bbox_to_anchor=(1, 1), prop={'size': 8})
     ax.set_ylim(bottom=0)
     ax.text(1, -0.12, '© Crown copyright and database right 2021, Royal Mail copyright and database right 2022',
             horizontalalignment='right', verticalalignment='top', transform=ax.transAxes)
     fig.tight_layout()
-    plt.close()
 
-    display(fig)
+    if show:
+        display(fig)
     return fig
 
 
@@ -351,19 +579,19 @@ def view_interactive_graph():
     save_button = widgets.Button(description="Save")
 
     def view_clicked(_):
-        output.clear_output()
-        with output:
-            try:
-                global graph
-                graph = view_queried_graph(year_range.value, property_types.value, display_size.value,
-                                           area_type=None if area_name.disabled else type_map[area_type.value],
-                                           area_name=None if area_name.disabled else area_name.value.upper(),
-                                           outcode=None if outcode.disabled else outcode.value.upper(),
-                                           latitude=None if latitude.disabled else latitude.value,
-                                           longitude=None if longitude.disabled else longitude.value,
-                                           boxsize=None if boxsize.disabled else boxsize.value)
-            except Exception as e:
-                print(e)
+        args = (year_range.value, property_types.value, display_size.value)
+        kwargs = dict(area_type=None if area_name.disabled else type_map[area_type.value],
+                      area_name=None if area_name.disabled else area_name.value.upper(),
+                      outcode=None if outcode.disabled else outcode.value.upper(),
+                      latitude=None if latitude.disabled else latitude.value,
+                      longitude=None if longitude.disabled else longitude.value,
+                      boxsize=None if boxsize.disabled else boxsize.value)
+
+        def done(fig):
+            global graph
+            graph = fig
+
+        background.submit(lambda: view_queried_graph(*args, **kwargs, show=False), done)
 
     def save_clicked(_):
         with output:
@@ -393,52 +621,81 @@ def view_interactive_graph():
     display(buttons)
     output = widgets.Output()
     display(output)
+    background = BackgroundView(output)
+
+
+@trace.traced('prices')
+def box_prices_data(lat_min, lat_max, lon_min, lon_max, start_date, end_date, columns=None):
+    lat_min, lat_max, lon_min, lon_max = map(Decimal, map(str, (lat_min, lat_max, lon_min, lon_max)))
+    data = access.tiled_prices_coordinates_data(lat_min, lat_max, lon_min, lon_max, start_date, end_date)
+    df = cache.read_table(data, columns=columns, start_date=start_date, end_date=end_date,
+                          lat_min=lat_min, lat_max=lat_max, lon_min=lon_min, lon_max=lon_max)
+    if 'property type' in df:
+        df['property type'] = df['property type'].map(property_type_map)
+    return df
+
+
+@trace.traced('reprojection')
+def property_points(latitudes, longitudes):
+    points = gpd.points_from_xy(longitudes, latitudes, crs=4326).to_crs(27700)
+    return np.column_stack([points.x, points.y])
 
 
+def poi_box(lat_min, lat_max, lon_min, lon_max, radius):
+    # POI features cover everything within radius (in degrees of latitude) of a point. A degree of longitude
+    # shrinks with cos(latitude), so the longitude margin is widened to keep every such POI in the box
+    lat_min, lat_max, lon_min, lon_max, radius = map(float, (lat_min, lat_max, lon_min, lon_max, radius))
+    lon_radius = radius / np.cos(np.radians(max(abs(lat_min - radius), abs(lat_max + radius))))
+    return lat_max + radius, lat_min - radius, lon_max + lon_radius, lon_min - lon_radius
+
+
+@trace.traced()
+def poi_indexes(north, south, east, west):
+    pois = pois_data(north, south, east, west, config['poi_map'].items(), crs=27700)
+    return [poi_index(pois.geometry[pois['display name'] == name]) for name in config['poi_map']]
+
+
+@trace.traced('poi features')
+def design_matrix(normalized_year, ptype, properties, pois, radius):
+    ptype_ind_0 = np.array([np.where(ptype == pt, 1, 0) for pt in property_types_list])
+    ptype_ind_1 = ptype_ind_0 * normalized_year
+    ptype_ind_2 = ptype_ind_0 * np.square(normalized_year)
+
+    number_of_pois = [count_pois(properties, poi, radius) for poi in pois]
+    distance_to_closest_pois = [dist_pois(properties, poi, radius) for poi in pois]
+
+    return np.column_stack([*ptype_ind_0, *ptype_ind_1, *ptype_ind_2, *number_of_pois, *distance_to_closest_pois])
+
+
+@trace.traced()
 def labelled(latitude, longitude, date, property_type, boxsize, radius, days):
     df = prices_coordinates_data(latitude=latitude, longitude=longitude, boxsize=boxsize,
                                  start_date=add_days(date, -days),
                                  end_date=add_days(date, days)
                                  if comp_date(add_days(date, days), str(this_year)+'-12-31')
-                                 else str(this_year)+'-12-31')
+                                 else str(this_year)+'-12-31',
+                                 columns=['price', 'date of transfer', 'property type', 'latitude', 'longitude'])
 
-    print("Constructing features...\n")
+    trace.progress("Constructing features...\n")
 
-    normalized_year = np.append(df['date of transfer'].apply(normalize_year).to_numpy(), normalize_year(date))
+    normalized_year = np.append(normalize_year(df['date of transfer']), normalize_year(date))
     property_type = property_type_map[property_type]
     ptype = np.append(df['property type'], property_type)
 
-    ptype_ind_0 = np.array([np.where(ptype == pt, 1, 0) for pt in property_types_list])
-    ptype_ind_1 = ptype_ind_0 * normalized_year
-    ptype_ind_2 = ptype_ind_0 * np.square(normalized_year)
-
     half = Decimal(0.5)
     latitude = Decimal(latitude)
     longitude = Decimal(longitude)
     boxsize = Decimal(boxsize)
     radius = Decimal(radius)
 
-    north = latitude + half * boxsize + radius
-    south = latitude - half * boxsize - radius
-    east = longitude + half * boxsize + radius
-    west = longitude - half * boxsize - radius
-
-    lats = df['latitude']
-    lats.loc[lats.index.max() + 1] = latitude
-    lons = df['longitude']
-    lons.loc[lons.index.max() + 1] = longitude
-
-    properties = gpd.points_from_xy(lons, lats)
-    properties.crs = 4326
-    properties = properties.to_crs(27700).to_numpy()
-
-    pois = [pois_data(north, south, east, west, [i]).to_crs(27700)['geometry'] for i in config['poi_map'].items()]
+    north, south, east, west = poi_box(latitude - half * boxsize, latitude + half * boxsize,
+                                       longitude - half * boxsize, longitude + half * boxsize, radius)
 
-    vc = np.vectorize(count_poi, excluded=['poi', 'radius'])
-    vd = np.vectorize(dist_poi, excluded=['poi', 'radius'])
+    lats = np.append(df['latitude'], float(latitude))
+    lons = np.append(df['longitude'], float(longitude))
 
-    number_of_pois = [vc(properties, poi=poi, radius=radius) for poi in pois]
-    distance_to_closest_pois = [vd(properties, poi=poi, radius=radius) for poi in pois]
+    properties = property_points(lats, lons)
+    pois = poi_indexes(north, south, east, west)
 
-    design_matrix = np.column_stack([*ptype_ind_0, *ptype_ind_1, *ptype_ind_2, *number_of_pois, *distance_to_closest_pois])
-    return design_matrix, df['price'].to_numpy(), lats.to_numpy(), lons.to_numpy(), normalized_year, ptype
+    return design_matrix(normalized_year, ptype, properties, pois, radius), df['price'].to_numpy(), \
+        lats, lons, normalized_year, ptype
@@ -0,0 +1,412 @@
+from .config import *
+from .utils import *
+from . import trace
+from .lazy import lazy, available
+
+import json
+import time
+import uuid
+import hashlib
+import numpy as np
+import sqlite3
+from contextlib import contextmanager
+from os import path, remove, makedirs, replace
+
+gpd = lazy('geopandas')
+pd = lazy('pandas')
+pa = lazy('pyarrow')
+ds = lazy('pyarrow.dataset')
+pq = lazy('pyarrow.parquet')
+
+
+manifest_filename = 'manifest.sqlite'
+
+categorical_columns = ['property type', 'new build flag', 'tenure type', 'country']
+
+filter_operators = {
+    '>=': lambda column, value: column >= value,
+    '<=': lambda column, value: column <= value,
+    '<': lambda column, value: column < value
+}
+
+
+def cache_format():
+    if config.get('cache_format', 'parquet') == 'parquet' and available('pyarrow'):
+        return 'parquet'
+    return 'csv'
+
+
+def typed_frame(df):
+    df['price'] = df['price'].astype('int64')
+    df['date of transfer'] = pd.to_datetime(df['date of transfer'], format='%Y-%m-%d')
+    df['latitude'] = df['latitude'].astype('float64')
+    df['longitude'] = df['longitude'].astype('float64')
+    for column in categorical_columns:
+        df[column] = df[column].astype('category')
+    return df
+
+
+def table_filters(start_date=None, end_date=None, lat_min=None, lat_max=None, lon_min=None, lon_max=None):
+    filters = []
+    if start_date is not None:
+        filters.append(('date of transfer', '>=', pd.Timestamp(start_date)))
+    if end_date is not None:
+        filters.append(('date of transfer', '<=', pd.Timestamp(end_date)))
+    if lat_min is not None:
+        filters += [('latitude', '>=', float(lat_min)), ('latitude', '<', float(lat_max)),
+                    ('longitude', '>=', float(lon_min)), ('longitude', '<', float(lon_max))]
+    return filters
+
+
+def apply_filters(df, filters, columns=None):
+    mask = pd.Series(True, index=df.index)
+    for column, op, value in filters:
+        mask &= filter_operators[op](df[column], value)
+    df = df.loc[mask]
+    return df if columns is None else df[list(columns)]
+
+
+def part_path(file_path):
+    # Unique per writer, so concurrent requests building the same tile never write into one file
+    return f"{file_path}.{uuid.uuid4().hex}.part"
+
+
+class TableWriter:
+    def __init__(self, filename):
+        self.path = path.join(tables, filename + '.' + cache_format())
+        self.part_path = part_path(self.path)
+        self.rows = 0
+        self.writer = None
+
+    def write(self, df):
+        if cache_format() == 'parquet':
+            # Sorting by date keeps row group statistics tight so date-bounded reads skip whole groups
+            table = pa.Table.from_pandas(df.sort_values('date of transfer'), preserve_index=False)
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.part_path, table.schema)
+            self.writer.write_table(table, row_group_size=config.get('cache_row_group_size', 50000))
+        else:
+            df.to_csv(self.part_path, mode='w' if self.writer is None else 'a', header=False, index=False,
+                      date_format='%Y-%m-%d', lineterminator='\n')
+            self.writer = self.part_path
+        self.rows += len(df)
+        trace.current().add(rows=len(df))
+
+    def close(self):
+        if self.writer is None:
+            self.write(typed_frame(pd.DataFrame(columns=table_column_list)))
+        if cache_format() == 'parquet':
+            self.writer.close()
+        replace(self.part_path, self.path)
+        trace.current().add(bytes=path.getsize(self.path))
+
+    def discard(self):
+        # A failed query leaves a partial file that is never recorded in the manifest, so it is removed
+        if cache_format() == 'parquet' and self.writer is not None:
+            self.writer.close()
+        if path.exists(self.part_path):
+            remove(self.part_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+def write_table(df, filename):
+    with TableWriter(filename) as writer:
+        writer.write(df)
+    return writer.path
+
+
+@trace.traced()
+def read_table(file_path, columns=None, start_date=None, end_date=None,
+               lat_min=None, lat_max=None, lon_min=None, lon_max=None):
+    filters = table_filters(start_date, end_date, lat_min, lat_max, lon_min, lon_max)
+    if isinstance(file_path, list):
+        df = concat_frames([read_file(fp, columns, filters) for fp in file_path])
+    else:
+        df = read_file(file_path, columns, filters)
+    trace.current().add(rows=len(df))
+    return df
+
+
+def read_file(file_path, columns, filters):
+    trace.current().add(bytes=path.getsize(file_path))
+    if file_path.endswith('.parquet'):
+        return pd.read_parquet(file_path, columns=columns, filters=filters or None)
+    return apply_filters(typed_frame(pd.read_csv(file_path, names=table_column_list)), filters, columns)
+
+
+def iter_table(file_path, columns=None, start_date=None, end_date=None,
+               lat_min=None, lat_max=None, lon_min=None, lon_max=None, chunk_size=None):
+    chunk_size = config.get('stream_chunk_size', 100000) if chunk_size is None else chunk_size
+    filters = table_filters(start_date, end_date, lat_min, lat_max, lon_min, lon_max)
+    for fp in (file_path if isinstance(file_path, list) else [file_path]):
+        if fp.endswith('.parquet'):
+            dataset = ds.dataset(fp, format='parquet')
+            for batch in dataset.to_batches(columns=columns, batch_size=chunk_size,
+                                            filter=pq.filters_to_expression(filters) if filters else None):
+                if batch.num_rows:
+                    yield batch.to_pandas()
+        else:
+            for chunk in pd.read_csv(fp, names=table_column_list, chunksize=chunk_size):
+                chunk = apply_filters(typed_frame(chunk), filters, columns)
+                if not chunk.empty:
+                    yield chunk
+
+
+def concat_frames(frames):
+    df = pd.concat(frames, ignore_index=True)
+    for column in categorical_columns:
+        if column in df:
+            df[column] = df[column].astype('category')
+    return df
+
+
+def tile_index(values, size):
+    # Snap to the decimal tile bounds used in SQL so rows on a boundary land in the same tile as in the query
+    values = np.asarray(values, dtype='float64')
+    index = np.floor(values / size).astype('int64')
+    index -= values < np.round(index * size, 10)
+    index += values >= np.round((index + 1) * size, 10)
+    return index
+
+
+def tile_bound(index, size):
+    return Decimal(int(index)) * Decimal(str(size))
+
+
+def tiles(lat_min, lat_max, lon_min, lon_max, start_date, end_date):
+    size = config.get('tile_size', 0.05)
+    years = config.get('tile_years', 5)
+    lat_tiles = range(int(tile_index(lat_min, size)), int(tile_index(lat_max, size)) + 1)
+    lon_tiles = range(int(tile_index(lon_min, size)), int(tile_index(lon_max, size)) + 1)
+    buckets = range(int(start_date[:4]) // years, int(end_date[:4]) // years + 1)
+    result = []
+    for i in lat_tiles:
+        if tile_bound(i, size) >= Decimal(str(lat_max)):
+            continue
+        for j in lon_tiles:
+            if tile_bound(j, size) >= Decimal(str(lon_max)):
+                continue
+            box = (tile_bound(i, size), tile_bound(i + 1, size), tile_bound(j, size), tile_bound(j + 1, size))
+            for b in buckets:
+                result.append((f"{i}#{j}#{b}", box, f"{b * years}-01-01", f"{b * years + years - 1}-12-31"))
+    return result
+
+
+def tile_keys(df):
+    size = config.get('tile_size', 0.05)
+    years = config.get('tile_years', 5)
+    return pd.Series(tile_index(df['latitude'], size).astype(str), index=df.index) + '#' + \
+        pd.Series(tile_index(df['longitude'], size).astype(str), index=df.index) + '#' + \
+        (df['date of transfer'].dt.year // years).astype(str)
+
+
+def osm_tiles(north, south, east, west):
+    size = config.get('osm_tile_size', 0.05)
+    result = []
+    for i in range(int(tile_index(float(south), size)), int(tile_index(float(north), size)) + 1):
+        for j in range(int(tile_index(float(west), size)), int(tile_index(float(east), size)) + 1):
+            result.append((i, j, (float(tile_bound(i + 1, size)), float(tile_bound(i, size)),
+                                  float(tile_bound(j + 1, size)), float(tile_bound(j, size)))))
+    return result
+
+
+def osm_selector_key(selector):
+    return hashlib.sha1(json.dumps(selector, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def osm_fresh(file_path):
+    if config.get('osm_offline', False):
+        return True
+    return time.time() - path.getmtime(file_path) < config.get('osm_cache_ttl_days', 30) * 86400
+
+
+def osm_data(kind, selector, fetch, north, south, east, west):
+    return osm_data_many(kind, [selector], lambda selectors: fetch, lambda data, selector: data,
+                         north, south, east, west)[0]
+
+
+def osm_data_many(kind, selectors, fetch, split, north, south, east, west):
+    # Each selector is cached in its own tiles, but everything missing is fetched in one request:
+    # fetch(selectors) returns a fetch function over the union of the given selectors and split(data, selector)
+    # picks one selector's rows, so any subset or combination of selectors reuses tiles from earlier requests
+    north, south, east, west = float(north), float(south), float(east), float(west)
+    if not available('pyarrow'):
+        data = fetch(selectors)(north, south, east, west)
+        return [split(data, selector) for selector in selectors]
+
+    makedirs(osm, exist_ok=True)
+    frames = [[] for _ in selectors]
+    missing = {}
+    for k, selector in enumerate(selectors):
+        key = osm_selector_key(selector)
+        for i, j, box in osm_tiles(north, south, east, west):
+            file_path = path.join(osm, f"{kind}#{key}#{i}#{j}#.parquet")
+            if path.exists(file_path) and osm_fresh(file_path):
+                frames[k].append(gpd.read_parquet(file_path))
+            else:
+                missing.setdefault(k, []).append((file_path, box))
+
+    boxes = [box for tiles in missing.values() for _, box in tiles]
+    trace.current().hit(sum(len(tiles) for tiles in frames))
+    trace.current().miss(len(boxes))
+    if missing and config.get('osm_offline', False):
+        trace.progress(f"Offline mode: {len(boxes)} OpenStreetMap tiles are not cached and are left out\n")
+    elif missing:
+        # Fetch all missing tiles in one request over their bounding box, then split it by selector and tile
+        with trace.span('osm fetch') as fetched:
+            data = fetch([selectors[k] for k in missing])(max(box[0] for box in boxes), min(box[1] for box in boxes),
+                                                          max(box[2] for box in boxes), min(box[3] for box in boxes))
+            fetched.add(rows=len(data))
+        for k, tiles in missing.items():
+            selected = split(data, selectors[k])
+            for file_path, (n, s, e, w) in tiles:
+                tile = selected.cx[w:e, s:n]
+                tile_part = part_path(file_path)
+                tile.to_parquet(tile_part)
+                replace(tile_part, file_path)
+                frames[k].append(tile)
+
+    result = []
+    for tiles in frames:
+        if not tiles:
+            result.append(gpd.GeoDataFrame(geometry=gpd.GeoSeries([], crs=4326)))
+            continue
+        data = pd.concat(tiles)
+        data = data.loc[~data.index.duplicated()]
+        result.append(data.cx[west:east, south:north])
+    return result
+
+
+@contextmanager
+def manifest():
+    makedirs(tables, exist_ok=True)
+    conn = sqlite3.connect(path.join(tables, manifest_filename))
+    try:
+        with conn:
+            create_manifest(conn)
+            yield conn
+    finally:
+        conn.close()
+
+
+def create_manifest(conn):
+    conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+                      `filename` text NOT NULL PRIMARY KEY,
+                      `area_type` text NOT NULL,
+                      `area_key` text NOT NULL,
+                      `lat_min` real,
+                      `lat_max` real,
+                      `lon_min` real,
+                      `lon_max` real,
+                      `start_date` text NOT NULL,
+                      `end_date` text NOT NULL,
+                      `rows` integer NOT NULL,
+                      `bytes` integer NOT NULL,
+                      `last_access` real NOT NULL
+                    )""")
+    conn.execute("""CREATE INDEX IF NOT EXISTS entries_area ON entries (area_type, area_key, start_date)""")
+    conn.execute("""CREATE INDEX IF NOT EXISTS entries_access ON entries (last_access)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS versions (
+                      `version` integer NOT NULL PRIMARY KEY,
+                      `delta` text,
+                      `created` real NOT NULL
+                    )""")
+
+
+def lookup(area_type, area_key, start_date, end_date):
+    with manifest() as conn:
+        row = conn.execute("""SELECT filename FROM entries
+                              WHERE area_type = ? AND area_key = ? AND start_date <= ? AND end_date >= ?
+                              LIMIT 1""", (area_type, area_key, start_date, end_date)).fetchone()
+        if row is None:
+            return None
+        conn.execute("""UPDATE entries SET last_access = ? WHERE filename = ?""", (time.time(), row[0]))
+    return path.join(tables, row[0])
+
+
+def record(file_path, area_type, area_key, start_date, end_date, rows, box=None, protect=()):
+    filename = path.basename(file_path)
+    lat_min, lat_max, lon_min, lon_max = (None,) * 4 if box is None else map(float, box)
+    with manifest() as conn:
+        conn.execute("""INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                     (filename, area_type, area_key, lat_min, lat_max, lon_min, lon_max, start_date, end_date,
+                      rows, path.getsize(file_path), time.time()))
+    # protect lists the other files a request is about to read, so eviction never removes them mid-request
+    evict(keep={filename} | {path.basename(p) for p in protect})
+
+
+def evict(budget=None, keep=()):
+    budget = config.get('cache_size_limit', 2 ** 30) if budget is None else budget
+    with manifest() as conn:
+        [total] = conn.execute("""SELECT COALESCE(SUM(bytes), 0) FROM entries""").fetchone()
+        if total <= budget:
+            return
+        evicted = []
+        for filename, size in conn.execute("""SELECT filename, bytes FROM entries ORDER BY last_access"""):
+            if total <= budget:
+                break
+            if filename in keep:
+                continue
+            evicted.append(filename)
+            total -= size
+        conn.executemany("""DELETE FROM entries WHERE filename = ?""", [(fn,) for fn in evicted])
+    for filename in evicted:
+        if path.exists(path.join(tables, filename)):
+            remove(path.join(tables, filename))
+
+
+def invalidate(delta=None):
+    with manifest() as conn:
+        filenames = [fn for fn, in conn.execute("""SELECT filename FROM entries""")]
+        conn.execute("""DELETE FROM entries""")
+        if delta is None:
+            # A load that is not a pure addition makes every earlier delta useless for incremental updates
+            filenames += [fn for fn, in conn.execute("""SELECT delta FROM versions WHERE delta IS NOT NULL""")]
+            conn.execute("""UPDATE versions SET delta = NULL""")
+        conn.execute("""INSERT INTO versions (delta, created) VALUES (?, ?)""",
+                     (None if delta is None else path.basename(delta), time.time()))
+    for filename in filenames:
+        if path.exists(path.join(tables, filename)):
+            remove(path.join(tables, filename))
+    trace.progress("Invalidated local cache\n")
+
+
+def data_version():
+    with manifest() as conn:
+        [version] = conn.execute("""SELECT COALESCE(MAX(version), 0) FROM versions""").fetchone()
+    return version
+
+
+def deltas_since(version):
+    with manifest() as conn:
+        rows = conn.execute("""SELECT delta FROM versions WHERE version > ? ORDER BY version""", (version,)).fetchall()
+    if any(delta is None for delta, in rows):
+        return None
+    return [path.join(tables, delta) for delta, in rows]
+
+
+def model_path(key):
+    return path.join(models, f"model#{key}#.npz")
+
+
+def load_model(key):
+    if not path.exists(model_path(key)):
+        return None
+    with np.load(model_path(key)) as model:
+        return dict(model)
+
+
+def save_model(key, **model):
+    makedirs(models, exist_ok=True)
+    # Write then rename so a concurrent reader never sees a half-written model
+    with open(model_path(key) + '.part', 'wb') as file:
+        np.savez(file, **model)
+    replace(model_path(key) + '.part', model_path(key))
@@ -0,0 +1,159 @@
+from .config import *
+from . import trace
+from .lazy import lazy
+
+import json
+import time
+import hashlib
+import threading
+from os import path, remove, replace
+
+urllib3 = lazy('urllib3')
+
+pool = None
+pool_lock = threading.Lock()
+
+retry_statuses = [429, 500, 502, 503, 504]
+
+
+def pool_manager():
+    # Keep-alive connections shared by every download worker. block caps each host at
+    # download_workers connections, so extra workers wait rather than opening more
+    global pool
+    with pool_lock:
+        if pool is None:
+            retries = urllib3.Retry(total=config.get('download_retries', 3),
+                                    backoff_factor=config.get('download_backoff', 0.5),
+                                    status_forcelist=retry_statuses, allowed_methods=['GET'],
+                                    raise_on_status=False)
+            timeout = urllib3.Timeout(connect=config.get('download_connect_timeout', 10),
+                                      read=config.get('download_read_timeout', 60))
+            pool = urllib3.PoolManager(maxsize=config.get('download_workers', 4), block=True, retries=retries,
+                                       timeout=timeout,
+                                       headers={'User-Agent': config.get('download_user_agent', 'Mozilla/5.0')})
+        return pool
+
+
+def meta_path(file_path):
+    return file_path + '.meta'
+
+
+def read_meta(file_path):
+    if not path.exists(meta_path(file_path)):
+        return None
+    with open(meta_path(file_path)) as file:
+        return json.load(file)
+
+
+def write_meta(file_path, meta):
+    with open(meta_path(file_path) + '.tmp', 'w') as file:
+        json.dump(meta, file, indent=2, sort_keys=True)
+    replace(meta_path(file_path) + '.tmp', meta_path(file_path))
+
+
+def remove_file(file_path):
+    for p in [file_path, meta_path(file_path)]:
+        if path.exists(p):
+            remove(p)
+
+
+def validators(response, fallback):
+    return {'etag': response.headers.get('ETag', fallback.get('etag')),
+            'last_modified': response.headers.get('Last-Modified', fallback.get('last_modified'))}
+
+
+def transfer(url, file_path, headers, checksum):
+    # Streams url into file_path.part, resuming from whatever a validated part already holds, and renames
+    # it over file_path once it is complete. Returns False when the server reports the file unchanged
+    part_path = file_path + '.part'
+    part_meta = read_meta(part_path) or {}
+    validator = part_meta.get('etag') or part_meta.get('last_modified')
+    if path.exists(part_path) and not validator:
+        # Without a validator there is no telling whether the part came from the file the server has now
+        remove_file(part_path)
+    offset = path.getsize(part_path) if path.exists(part_path) else 0
+    # The bytes are saved as sent, so ask for them without a content encoding
+    headers = {**headers, 'Accept-Encoding': 'identity'}
+    if offset:
+        # If-Range makes the server send the whole file instead when it changed since the part was written
+        headers['Range'] = f'bytes={offset}-'
+        headers['If-Range'] = validator
+
+    response = pool_manager().request('GET', url, headers=headers, preload_content=False)
+    try:
+        if response.status == 304:
+            return False
+        if response.status == 416 and offset:
+            # The part already holds every byte, unless the file shrank on the server
+            total = response.headers.get('Content-Range', '').rpartition('/')[2]
+            if total != str(offset):
+                remove_file(part_path)
+                raise urllib3.exceptions.ProtocolError(f"{url} no longer matches the partial download")
+            meta = validators(response, part_meta)
+        elif response.status == 404:
+            raise FileNotFoundError(f"{url} returned HTTP 404")
+        elif response.status >= 400:
+            raise OSError(f"{url} returned HTTP {response.status}")
+        else:
+            if response.status != 206:
+                offset = 0
+            meta = validators(response, part_meta if offset else {})
+            write_meta(part_path, meta)
+            expected = response.headers.get('Content-Length')
+            received = 0
+            with open(part_path, 'ab' if offset else 'wb') as file:
+                for chunk in response.stream(config.get('download_chunk_size', 1 << 20), decode_content=False):
+                    file.write(chunk)
+                    received += len(chunk)
+            if expected is not None and received < int(expected):
+                raise urllib3.exceptions.ProtocolError(f"{url} ended after {received} of {expected} bytes")
+    finally:
+        response.release_conn()
+
+    digest = hashlib.sha256()
+    with open(part_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    if checksum is not None and digest.hexdigest() != checksum:
+        remove_file(part_path)
+        raise ValueError(f"{url} failed checksum verification")
+
+    replace(part_path, file_path)
+    remove_file(part_path)
+    write_meta(file_path, {'url': url, 'size': path.getsize(file_path), 'sha256': digest.hexdigest(),
+                           'downloaded': time.time(), **meta})
+    return True
+
+
+def fetch(url, file_path, checksum=None, headers=None):
+    # Downloads url to file_path, returning True when the file was (re)downloaded and False when the
+    # local copy is current. A complete copy is revalidated with its ETag/Last-Modified, so unchanged
+    # files cost one 304; an interrupted download resumes from file_path.part with a Range request
+    # guarded by If-Range
+    checksum = config.get('download_checksums', {}).get(url) if checksum is None else checksum
+    meta = read_meta(file_path)
+    if path.exists(file_path) and not config.get('download_revalidate', True):
+        return False
+
+    complete = path.exists(file_path) and meta is not None and meta['size'] == path.getsize(file_path) and \
+        (checksum is None or meta['sha256'] == checksum)
+    # A file without a record of finishing may be truncated, so it is not revalidated but downloaded again
+    # with a plain GET. It stays in place until the new copy is complete and renamed over it
+    headers = dict(headers or {})
+    if complete and meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if complete and meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+
+    retries = config.get('download_retries', 3)
+    for attempt in range(retries + 1):
+        try:
+            return transfer(url, file_path, headers, checksum)
+        except urllib3.exceptions.HTTPError as e:
+            if attempt < retries:
+                time.sleep(config.get('download_backoff', 0.5) * 2 ** attempt)
+            elif complete:
+                trace.progress(f"{url} could not be revalidated ({e}), using the local copy.\n")
+                return False
+            else:
+                raise
@@ -0,0 +1,40 @@
+import importlib
+import importlib.util
+
+
+class LazyModule:
+    # Stands in for a module (or one of its attributes) and imports it on first use, so
+    # importing fynesse does not pay for osmnx, geopandas, matplotlib and friends up front
+    def __init__(self, name, submodules, attribute):
+        self.__dict__.update(name=name, submodules=submodules, attribute=attribute, target=None)
+
+    def load(self):
+        target = self.__dict__['target']
+        if target is None:
+            target = importlib.import_module(self.__dict__['name'])
+            for submodule in self.__dict__['submodules']:
+                importlib.import_module(submodule)
+            if self.__dict__['attribute'] is not None:
+                target = getattr(target, self.__dict__['attribute'])
+            self.__dict__['target'] = target
+        return target
+
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self.load(), attribute, value)
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+    def __repr__(self):
+        return f"<lazy {self.__dict__['name']}>"
+
+
+def lazy(name, *submodules, attribute=None):
+    return LazyModule(name, submodules, attribute)
+
+
+def available(name):
+    return importlib.util.find_spec(name) is not None
@@ -0,0 +1,162 @@
+import os
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from fynesse import download
+from fynesse.config import config
+
+
+class Server:
+    # A local HTTP server with ETag/Last-Modified validators and Range support. truncate makes the next
+    # full response stop after that many bytes, as a dropped connection would
+    def __init__(self):
+        self.content = b''
+        self.version = 0
+        self.truncate = None
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.requests.append(dict(self.headers))
+                etag = f'"v{server.version}"'
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+
+                body = server.content
+                start = 0
+                ranged = self.headers.get('Range')
+                if ranged and self.headers.get('If-Range', etag) == etag:
+                    start = int(ranged[len('bytes='):].rstrip('-'))
+                    if start >= len(body):
+                        self.send_response(416)
+                        self.send_header('Content-Range', f'bytes */{len(body)}')
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                        return
+                    self.send_response(206)
+                    self.send_header('Content-Range', f'bytes {start}-{len(body) - 1}/{len(body)}')
+                else:
+                    self.send_response(200)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body) - start))
+                self.end_headers()
+                if server.truncate is not None:
+                    self.wfile.write(body[start:start + server.truncate])
+                    server.truncate = None
+                    self.close_connection = True
+                    return
+                self.wfile.write(body[start:])
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}/data.csv'
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def publish(self, content):
+        self.content = content
+        self.version += 1
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setitem(config, 'download_backoff', 0)
+    monkeypatch.setitem(config, 'download_revalidate', True)
+    monkeypatch.setattr(download, 'pool', None)
+    server = Server()
+    server.publish(os.urandom(300000))
+    yield server
+    server.httpd.shutdown()
+    server.httpd.server_close()
+
+
+def test_download_then_revalidate(server, tmp_path):
+    file_path = str(tmp_path / 'data.csv')
+    assert download.fetch(server.url, file_path)
+    assert open(file_path, 'rb').read() == server.content
+    assert not os.path.exists(file_path + '.part')
+
+    assert not download.fetch(server.url, file_path)
+    assert server.requests[-1]['If-None-Match'] == '"v1"'
+
+    server.publish(b'changed')
+    assert download.fetch(server.url, file_path)
+    assert open(file_path, 'rb').read() == b'changed'
+
+
+def test_resume_after_dropped_connection(server, tmp_path):
+    file_path = str(tmp_path / 'data.csv')
+    server.truncate = 100000
+    assert download.fetch(server.url, file_path)
+    assert open(file_path, 'rb').read() == server.content
+    assert server.requests[-1]['Range'] == 'bytes=100000-'
+    assert server.requests[-1]['If-Range'] == '"v1"'
+
+
+def test_partial_from_older_version_restarts(server, tmp_path):
+    file_path = str(tmp_path / 'data.csv')
+    with open(file_path + '.part', 'wb') as file:
+        file.write(server.content[:1000])
+    download.write_meta(file_path + '.part', {'etag': '"v0"', 'last_modified': None})
+    assert download.fetch(server.url, file_path)
+    assert open(file_path, 'rb').read() == server.content
+    assert server.requests[-1]['If-Range'] == '"v0"'
+
+
+def test_unrecorded_file_is_downloaded_again(server, tmp_path):
+    file_path = str(tmp_path / 'data.csv')
+    with open(file_path, 'wb') as file:
+        file.write(server.content[:5000])
+    assert download.fetch(server.url, file_path)
+    assert open(file_path, 'rb').read() == server.content
+    assert 'Range' not in server.requests[-1]
+
+
+def test_failed_download_keeps_unrecorded_file(server, tmp_path, monkeypatch):
+    file_path = str(tmp_path / 'data.csv')
+    with open(file_path, 'wb') as file:
+        file.write(b'old')
+    monkeypatch.setitem(config, 'download_retries', 0)
+    server.httpd.shutdown()
+    server.httpd.server_close()
+    with pytest.raises(Exception):
+        download.fetch(server.url, file_path)
+    assert open(file_path, 'rb').read() == b'old'
+
+
+def test_unvalidated_part_restarts(server, tmp_path):
+    file_path = str(tmp_path / 'data.csv')
+    with open(file_path + '.part', 'wb') as file:
+        file.write(b'x' * 1000)
+    assert download.fetch(server.url, file_path)
+    assert open(file_path, 'rb').read() == server.content
+    assert 'Range' not in server.requests[-1]
+    assert server.requests[-1]['Accept-Encoding'] == 'identity'
+
+
+def test_checksum_mismatch(server, tmp_path):
+    file_path = str(tmp_path / 'data.csv')
+    with pytest.raises(ValueError):
+        download.fetch(server.url, file_path, checksum='0' * 64)
+    assert not os.path.exists(file_path)
+    assert not os.path.exists(file_path + '.part')
+    assert download.fetch(server.url, file_path, checksum=hashlib.sha256(server.content).hexdigest())
+
+
+def test_no_revalidation(server, tmp_path, monkeypatch):
+    file_path = str(tmp_path / 'data.csv')
+    download.fetch(server.url, file_path)
+    monkeypatch.setitem(config, 'download_revalidate', False)
+    server.publish(b'changed')
+    assert not download.fetch(server.url, file_path)
+    assert len(server.requests) == 1
@@ -0,0 +1,44 @@
+import sys
+import json
+import subprocess
+
+import pytest
+
+# Import budget in milliseconds for the package and for the lightweight submodules, measured
+# in a fresh interpreter so earlier imports in the test session do not hide the cost
+budget = 200
+
+heavy = ['pandas', 'geopandas', 'osmnx', 'matplotlib', 'sklearn', 'ipywidgets', 'IPython', 'duckdb', 'pyarrow']
+
+script = '''
+import sys, json, time
+start = time.perf_counter()
+import {modules}
+print(json.dumps({{'ms': (time.perf_counter() - start) * 1000, 'modules': sorted(sys.modules)}}))
+'''
+
+
+def measure(modules):
+    # Best of three runs, so a cold disk cache on the first run does not fail the budget
+    runs = []
+    for _ in range(3):
+        output = subprocess.run([sys.executable, '-c', script.format(modules=modules)],
+                                capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(output))
+    return min(runs, key=lambda run: run['ms'])
+
+
+@pytest.mark.parametrize('modules', ['fynesse', 'fynesse.config, fynesse.utils, fynesse.trace',
+                                     'fynesse.access, fynesse.cache', 'fynesse.assess, fynesse.address'])
+def test_import_budget(modules):
+    run = measure(modules)
+    assert run['ms'] < budget, f"import {modules} took {run['ms']:.0f}ms"
+    loaded = {name.split('.')[0] for name in run['modules']}
+    assert not loaded & set(heavy), f"import {modules} loaded {sorted(loaded & set(heavy))}"
+
+
+def test_submodules_load_on_access():
+    import fynesse
+    assert fynesse.access.__name__ == 'fynesse.access'
+    with pytest.raises(AttributeError):
+        fynesse.missing
@@ -0,0 +1,60 @@
+import itertools
+
+import pytest
+
+from fynesse import access, assess
+from fynesse.config import config
+
+pytest.importorskip('duckdb')
+pytest.importorskip('pyarrow')
+
+# With tile_size 0.05 and tile_years 5, these sit on tile bounds, just either side of them, or inside a tile.
+# 52.05, 52.3, 0.15, 0.3 and 0.35 are bounds where floor(value / 0.05) lands one tile low in floating point
+latitudes = [52.05, 52.1, 52.15, 52.3, 52.049999, 52.050001, 52.123]
+longitudes = [0.1, 0.15, 0.3, 0.35, 0.149999, 0.150001, 0.2]
+dates = ['2009-12-31', '2010-01-01', '2012-06-15', '2014-12-31', '2015-01-01', '2019-12-31', '2020-01-01']
+
+boxes = [
+    (52.05, 52.15, 0.15, 0.3, '2010-01-01', '2019-12-31'),
+    (52.05, 52.3, 0.1, 0.35, '2009-01-01', '2020-12-31'),
+    (52.049999, 52.123, 0.149999, 0.2, '2012-06-15', '2015-01-01'),
+    (52.1, 52.3, 0.15, 0.35, '2009-12-31', '2020-01-01'),
+]
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    # A DuckDB transactions table with a sale at every combination of the coordinates and dates above
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(config, 'backend', 'duckdb')
+    monkeypatch.setitem(config, 'tile_size', 0.05)
+    monkeypatch.setitem(config, 'tile_years', 5)
+    monkeypatch.setattr(access, 'local_conn', None)
+    access.create_directories()
+    conn = access.local_database()
+    conn.execute("""CREATE TABLE transactions (price INTEGER, date_of_transfer DATE, postcode VARCHAR,
+                    property_type VARCHAR, new_build_flag VARCHAR, tenure_type VARCHAR, locality VARCHAR,
+                    town_city VARCHAR, district VARCHAR, county VARCHAR, country VARCHAR, latitude DOUBLE,
+                    longitude DOUBLE)""")
+    rows = [(100000 + i, date, 'CB1 1AA', 'D', 'N', 'F', '', 'CAMBRIDGE', 'CAMBRIDGE', 'CAMBRIDGESHIRE', 'England',
+             latitude, longitude)
+            for i, (latitude, longitude, date) in enumerate(itertools.product(latitudes, longitudes, dates))]
+    conn.executemany("INSERT INTO transactions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    yield conn
+    conn.close()
+    access.local_conn = None
+
+
+def expected(conn, lat_min, lat_max, lon_min, lon_max, start_date, end_date):
+    return conn.execute(f"""SELECT COUNT(*) FROM transactions WHERE latitude >= {lat_min} AND latitude < {lat_max}
+                            AND longitude >= {lon_min} AND longitude < {lon_max} AND
+                            date_of_transfer >= '{start_date}' AND date_of_transfer <= '{end_date}'""").fetchone()[0]
+
+
+def test_tiles_match_query_bounds(database):
+    for box in boxes:
+        count = expected(database, *box)
+        assert count > 0
+        # The first request fetches and splits the tiles, the second reads them back from the cache
+        assert len(assess.box_prices_data(*box)) == count
+        assert len(assess.box_prices_data(*box)) == count
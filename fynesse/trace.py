@@ -0,0 +1,245 @@
+from .config import *
+
+import sys
+import csv
+import json
+import time
+import pstats
+import functools
+import logging
+import cProfile
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger('fynesse.trace')
+progress_logger = logging.getLogger('fynesse.progress')
+
+enabled = config.get('trace', False)
+spans = []
+spans_lock = threading.Lock()
+local = threading.local()
+
+record_fields = ['name', 'path', 'depth', 'start', 'seconds', 'rows', 'bytes', 'hits', 'misses']
+
+
+class NullSpan:
+    # Returned while tracing is off, so instrumented code pays one call and no allocation
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def add(self, rows=0, bytes=0):
+        pass
+
+    def hit(self, count=1):
+        pass
+
+    def miss(self, count=1):
+        pass
+
+    def event(self, message):
+        pass
+
+
+null_span = NullSpan()
+
+
+class Span:
+    def __init__(self, name, profile=False, **attributes):
+        self.name = name
+        self.attributes = attributes
+        self.rows = 0
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.children = []
+        self.events = []
+        self.parent = None
+        self.profiler = cProfile.Profile() if profile else None
+        self.profile = None
+        self.start = None
+        self.seconds = None
+
+    def __enter__(self):
+        stack = local.__dict__.setdefault('stack', [])
+        self.parent = stack[-1] if stack else None
+        stack.append(self)
+        self.start = time.time()
+        self.clock = time.perf_counter()
+        if self.profiler is not None:
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profile = pstats.Stats(self.profiler)
+            self.profiler = None
+        self.seconds = time.perf_counter() - self.clock
+        local.stack.pop()
+        if self.parent is None:
+            with spans_lock:
+                spans.append(self)
+        else:
+            self.parent.children.append(self)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s %.3fs rows=%d bytes=%d hits=%d misses=%d", self.path(), self.seconds, self.rows,
+                         self.bytes, self.hits, self.misses)
+        return False
+
+    def add(self, rows=0, bytes=0):
+        self.rows += rows
+        self.bytes += bytes
+
+    def hit(self, count=1):
+        self.hits += count
+
+    def miss(self, count=1):
+        self.misses += count
+
+    def event(self, message):
+        self.events.append((time.perf_counter() - self.clock, message))
+
+    def path(self):
+        return self.name if self.parent is None else self.parent.path() + '/' + self.name
+
+
+def span(name, profile=False, **attributes):
+    if not enabled:
+        return null_span
+    return Span(name, profile=profile or name in config.get('trace_profile', []), **attributes)
+
+
+def current():
+    stack = getattr(local, 'stack', None)
+    return stack[-1] if enabled and stack else null_span
+
+
+class StdoutHandler(logging.StreamHandler):
+    # Looks sys.stdout up for every message, so notebooks and output widgets that swap it still capture progress
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+    def filter(self, record):
+        # A thread whose progress is captured elsewhere, such as an output widget, does not print it too
+        return not getattr(local, 'captured', False) and super().filter(record)
+
+
+@contextmanager
+def captured():
+    local.captured = True
+    try:
+        yield
+    finally:
+        local.captured = False
+
+
+def progress(message):
+    # Pipeline progress messages go to the fynesse.progress logger, which prints them to stdout unless
+    # progress is turned off, and are kept on the current span as timed events while tracing
+    current().event(message.strip())
+    progress_logger.info(message)
+
+
+if config.get('progress', True):
+    progress_logger.addHandler(StdoutHandler())
+    progress_logger.setLevel(logging.INFO)
+    progress_logger.propagate = False
+
+
+def bind(function):
+    # Wraps function to run under the span current at the call to bind, so work submitted to a pool nests
+    # under the stage that submitted it instead of starting a new root on the worker thread
+    parent = current()
+    if parent is null_span:
+        return function
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        stack = local.__dict__.setdefault('stack', [])
+        stack.append(parent)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stack.pop()
+    return wrapper
+
+
+def traced(name=None):
+    def decorator(function):
+        label = function.__name__ if name is None else name
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with span(label):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def enable(profile=None):
+    global enabled
+    enabled = True
+    if profile is not None:
+        config['trace_profile'] = list(profile)
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    with spans_lock:
+        spans.clear()
+
+
+def walk(roots=None, depth=0):
+    for s in (spans if roots is None else roots):
+        yield s, depth
+        yield from walk(s.children, depth + 1)
+
+
+def records():
+    return [{'name': s.name, 'path': s.path(), 'depth': depth, 'start': s.start, 'seconds': s.seconds,
+             'rows': s.rows, 'bytes': s.bytes, 'hits': s.hits, 'misses': s.misses, **s.attributes}
+            for s, depth in walk()]
+
+
+def to_json(file_path):
+    def tree(s):
+        return {'name': s.name, 'start': s.start, 'seconds': s.seconds, 'rows': s.rows, 'bytes': s.bytes,
+                'hits': s.hits, 'misses': s.misses, 'attributes': s.attributes,
+                'events': [{'seconds': seconds, 'message': message} for seconds, message in s.events],
+                'children': [tree(child) for child in s.children]}
+    with open(file_path, 'w') as file:
+        json.dump([tree(s) for s in spans], file, indent=2, default=str)
+
+
+def to_csv(file_path):
+    rows = records()
+    fields = record_fields + sorted({key for row in rows for key in row} - set(record_fields))
+    with open(file_path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def to_logger(target=None, level=logging.INFO):
+    target = logger if target is None else target
+    for row in records():
+        target.log(level, "%s%s %.3fs rows=%d bytes=%d hits=%d misses=%d", '  ' * row['depth'], row['name'],
+                   row['seconds'], row['rows'], row['bytes'], row['hits'], row['misses'])
+
+
+def profiles():
+    return {s.path(): s.profile for s, _ in walk() if s.profile is not None}
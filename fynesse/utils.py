@@ -1,14 +1,21 @@
 import datetime
+import numpy as np
 from decimal import Decimal
+from .lazy import lazy
+
+cKDTree = lazy('scipy.spatial', attribute='cKDTree')
 
 tables = 'tables'
 datasets = 'datasets'
 maps = 'maps'
 graphs = 'graphs'
+osm = 'osm'
+models = 'models'
 
 degree = Decimal(111)
 
 day_zero = datetime.datetime(year=1995, month=1, day=1)
+day_zero_day = np.datetime64('1995-01-01', 'D')
 this_year = datetime.date.today().year
 
 property_type_map = {
@@ -57,35 +64,47 @@ def get_filename(area_type='town_city', area_name='CAMBRIDGE', outcode=None, lat
         return area_type + '#' + area_name.replace(" ", "_").replace("'", "_") + '#' + start_date + '#' + end_date + '#'
 
 
-def normalize_year(date):
-    return (datetime.datetime.strptime(date, '%Y-%m-%d') - day_zero).days / 365.
+def get_tile_filename(key):
+    return "tile" + "#" + key + "#"
 
 
-def comp_date(earlier, later):
-    return datetime.datetime.strptime(earlier, '%Y-%m-%d') <= datetime.datetime.strptime(later, '%Y-%m-%d')
+def get_delta_filename(key):
+    return "delta" + "#" + key + "#"
+
+
+def to_days(dates):
+    return np.asarray(dates, dtype='datetime64[D]')
+
+
+def normalize_year(dates):
+    return (to_days(dates) - day_zero_day).astype('float64') / 365.
 
 
-def add_days(date, days):
-    return (datetime.datetime.strptime(date, '%Y-%m-%d') + datetime.timedelta(days=days)).strftime('%Y-%m-%d')
+def comp_date(earlier, later):
+    return to_days(earlier) <= to_days(later)
+
 
+def add_days(dates, days):
+    shifted = to_days(dates) + np.asarray(days, dtype='timedelta64[D]')
+    return str(shifted) if isinstance(dates, str) else shifted
 
 
 def isclose(x, y):
     return abs(x - y) <= Decimal('0.000001')
 
 
-def count_poi(p, poi, radius):
-    radius = radius * 111000
-    dists = poi.distance(p)
-    return len(dists < radius)
+def poi_index(poi):
+    coordinates = np.column_stack([poi.x, poi.y]) if len(poi) else np.empty((0, 2))
+    return cKDTree(coordinates)
 
 
-def dist_poi(p, poi, radius):
+def count_pois(properties, index, radius):
     radius = float(radius * 111000)
-    dists = poi.distance(p)
-    dists = dists[dists < radius]
-    if dists.empty:
-        dist = radius
-    else:
-        dist = dists.min()
-    return -(1 / radius) * dist + 1
+    return index.query_ball_point(properties, radius, return_length=True)
+
+
+def dist_pois(properties, index, radius):
+    radius = float(radius * 111000)
+    dists, _ = index.query(properties, distance_upper_bound=radius)
+    dists = np.minimum(dists, radius)
+    return -(1 / radius) * dists + 1
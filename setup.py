@@ -28,12 +28,14 @@ VERSION = "0.1.0"
 # What packages are required for this module to be executed?
 REQUIRED = [
     "pandas", "numpy", "jupyter", "matplotlib", "pyyaml", "ipywidgets",
-    "pymysql", "osmnx", "geopandas", "IPython", "scikit-learn", "shapely"
+    "pymysql", "osmnx", "geopandas", "IPython", "scikit-learn", "shapely", "scipy", "urllib3"
 ]
 
 # What packages are optional?
 EXTRAS = {
-
+    "cache": ["pyarrow"],
+    "local": ["duckdb", "pyarrow"],
+    "benchmarks": ["pytest", "pytest-benchmark", "duckdb", "pyarrow"],
 }
 
 PACKAGE_DATA = {"fynesse": ["defaults.yml"]}